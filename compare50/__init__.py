@@ -23,4 +23,5 @@ _set_version()
 
 from ._api import *
 from ._data import *
+from ._cache import *
 from . import comparators, preprocessors, passes
@@ -17,7 +17,7 @@ import attr
 import lib50
 import termcolor
 
-from . import comparators, _api, _data, _renderer, __version__
+from . import comparators, _api, _cache, _data, _renderer, __version__
 
 
 def excepthook(cls, exc, tb):
@@ -137,9 +137,11 @@ class IncludeExcludeAction(argparse.Action):
             self.callback(v)
 
 
-PROFILE = [ _api.compare
+PROFILE = [ _api.compare_stream
+          , _api._results
           , comparators.Winnowing.score
           , comparators.Winnowing.compare
+          , comparators.Winnowing._comparisons
           , comparators._winnowing.Index.hashes
           , comparators._winnowing.CompareIndex.fingerprint
           , comparators._winnowing.ScoreIndex.fingerprint
@@ -188,6 +190,36 @@ def print_stats(subs, archives, distro_files):
     termcolor.cprint(fmt.format_map(data), "yellow", attrs=["bold"])
 
 
+def print_prune_stats(pruned, max_frequency):
+    data = PluralDict(fingerprints=pruned.fingerprints, postings=pruned.postings, pairs=pruned.pairs,
+                      seconds=round(pruned.seconds, 2))
+    limit = f"{max_frequency:.0%} of submissions" if isinstance(max_frequency, float) else f"{max_frequency} files"
+    fmt = "Skipped {fingerprints} fingerprint{fingerprints(s)} in more than " + limit + \
+          " ({postings} posting{postings(s)}, {pairs} pair{pairs(s)} of postings, saving about {seconds} second{seconds(s)})"
+    termcolor.cprint(fmt.format_map(data), "yellow", attrs=["bold"])
+
+
+def frequency(value):
+    """Type of --max-frequency: a number of files, or a fraction of submissions."""
+    try:
+        files = int(value)
+    except ValueError:
+        fraction = float(value)
+    else:
+        if files < 1:
+            raise argparse.ArgumentTypeError(f"{value} is not a number of files, which must be at least 1")
+        return files
+    if not 0 < fraction <= 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a number of files, nor a fraction between 0 and 1")
+    return fraction
+
+
+def print_cache_stats(cache):
+    data = PluralDict(hits=cache.hits, misses=cache.misses)
+    fmt = "Token cache: {hits} hit{hits(s)}, {misses} miss{misses(es)}"
+    termcolor.cprint(fmt.format_map(data), "yellow", attrs=["bold"])
+
+
 def expand_patterns(patterns):
     """
     Given a list of glob patterns, return a flat list containing the result
@@ -196,6 +228,103 @@ def expand_patterns(patterns):
     return list(itertools.chain.from_iterable(map(lambda x: glob.glob(x, recursive=True), patterns)))
 
 
+def index_main(argv=None):
+    """
+    ``compare50-index build``: fingerprint archive submissions once, for use with ``--archive-index``.
+    ``compare50-index add``: add archive submissions to such an index.
+
+    A command of its own rather than a subcommand of ``compare50``, whose arguments are paths.
+    """
+    submission_factory = SubmissionFactory()
+
+    parser = ArgParser(prog="compare50-index")
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    build_parser = subparsers.add_parser("build",
+                                         help="Fingerprint archive submissions and store them in an index")
+    build_parser.add_argument("archive",
+                              nargs="+",
+                              help="Paths to archive submissions")
+    build_parser.add_argument("-o", "--output",
+                              action="store",
+                              required=True,
+                              type=pathlib.Path,
+                              help="location of the index")
+    build_parser.add_argument("-p", "--pass",
+                              dest="pass_",
+                              default=_data.Pass._get_all()[0].__name__,
+                              help="Pass to build the index for, the one compare50 ranks by (default: %(default)s).")
+
+    add_parser = subparsers.add_parser("add",
+                                       help="Fingerprint archive submissions and add them to an existing index")
+    add_parser.add_argument("output",
+                            metavar="index",
+                            type=pathlib.Path,
+                            help="location of the index")
+    add_parser.add_argument("archive",
+                            nargs="+",
+                            help="Paths to archive submissions")
+
+    for subparser in (build_parser, add_parser):
+        subparser.add_argument("-i", "--include",
+                               callback=submission_factory.include,
+                               nargs="+",
+                               action=IncludeExcludeAction,
+                               help="Globbing patterns to include from every submission."
+                                    " Includes everything (*) by default."
+                                    " Make sure to quote your patterns to escape any shell globbing!")
+        subparser.add_argument("-x", "--exclude",
+                               callback=submission_factory.exclude,
+                               nargs="+",
+                               action=IncludeExcludeAction,
+                               help="Globbing patterns to exclude from every submission."
+                                    " Nothing is excluded by default."
+                                    " Make sure to quote your patterns to escape any shell globbing!")
+        subparser.add_argument("-v", "--verbose",
+                               action="store_true",
+                               help="display the full tracebacks of any errors")
+        subparser.add_argument("--debug",
+                               action="store_true",
+                               help="don't run anything in parallel, disable progress bar")
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error("a command is required")
+
+    excepthook.verbose = args.verbose
+    args.archive = expand_patterns(args.archive)
+
+    if args.debug:
+        _api.Executor = _api.FauxExecutor
+
+    if args.command == "build":
+        try:
+            pass_ = _data.Pass._get(args.pass_)
+        except KeyError as e:
+            raise _api.Error("{} is not a pass, try one of these: {}"
+                               .format(e.args[0], [c.__name__ for c in _data.Pass._get_all()]))
+        index = None
+    else:
+        index = comparators.ArchiveIndex.load(args.output)
+        pass_ = _data.Pass._get(index.pass_name)
+
+    preprocessor = _data.Preprocessor(pass_.preprocessors)
+    with _api.progress_bar("Preparing", total=len(args.archive), disable=args.debug):
+        archive_subs = submission_factory.get_all(args.archive, preprocessor, is_archive=True)
+
+    if not archive_subs:
+        raise _api.Error("At least one non-empty archive submission is required.")
+
+    with _api.progress_bar(f"Indexing ({pass_.__name__})", disable=args.debug):
+        if index is None:
+            index = comparators.ArchiveIndex.build(archive_subs, pass_)
+        else:
+            index.append(archive_subs)
+        index.save(args.output)
+
+    termcolor.cprint(f"Done! Indexed {len(archive_subs)} archive submission{'s' if len(archive_subs) != 1 else ''}"
+                     f" in {args.output}, which now holds {len(index)}.", "green")
+
+
 def main():
     submission_factory = SubmissionFactory()
 
@@ -203,10 +332,21 @@ def main():
     parser.add_argument("submissions",
                         nargs="+",
                         help="Paths to submissions to compare")
-    parser.add_argument("-a", "--archive",
-                        nargs="+",
-                        default=[],
-                        help="Paths to archive submissions. Archive submissions are not compared against other archive submissions, only against regular submissions.")
+    archive_group = parser.add_mutually_exclusive_group()
+    archive_group.add_argument("-a", "--archive",
+                               nargs="+",
+                               default=[],
+                               help="Paths to archive submissions. Archive submissions are not compared against other archive submissions, only against regular submissions.")
+    archive_group.add_argument("--archive-index",
+                               action="store",
+                               type=pathlib.Path,
+                               metavar="PATH",
+                               help="Index of archive submissions (built with compare50-index build) to use instead of --archive."
+                                    " Archive submissions then need not be fingerprinted again.")
+    parser.add_argument("--update-index",
+                        action="store_true",
+                        help="Add the submissions to the archive index (which is created if need be), along with the"
+                             " top matches, so that later runs only score new submissions against the ones before them.")
     parser.add_argument("-d", "--distro",
                         nargs="+",
                         default=[],
@@ -237,6 +377,10 @@ def main():
                         default="results",
                         type=pathlib.Path,
                         help="location of compare50's output")
+    parser.add_argument("--inline",
+                        action="store_true",
+                        help="inline the CSS and JavaScript of compare50's output into every page, so that each page is"
+                             " self-contained, rather than writing them once to OUTPUT/static")
     parser.add_argument("-v", "--verbose",
                         action="store_true",
                         help="display the full tracebacks of any errors")
@@ -246,6 +390,31 @@ def main():
                         metavar="MATCHES",
                         type=int,
                         help="number of matches to output")
+    parser.add_argument("--max-frequency",
+                        action="store",
+                        type=frequency,
+                        metavar="FREQUENCY",
+                        help="when ranking, skip fingerprints (such as boilerplate) that occur in more than this many files,"
+                             " or in more than this fraction of submissions if a fraction (e.g. 0.9). Skips nothing by default.")
+    parser.add_argument("--lsh",
+                        nargs=2,
+                        type=int,
+                        metavar=("BANDS", "ROWS"),
+                        help="only score pairs of submissions that locality-sensitive hashing (with BANDS bands of ROWS"
+                             " MinHashes each) proposes, for very large cohorts. More bands or fewer rows find more"
+                             " matches, but take longer (e.g. 64 2).")
+    parser.add_argument("--cache-dir",
+                        action="store",
+                        type=pathlib.Path,
+                        help="directory in which to cache tokens across runs, so that unchanged files need not be lexed and"
+                             " preprocessed again. Cached tokens are unpickled, so this directory must not be shared with"
+                             " or writable by other users.")
+    parser.add_argument("--cache-size",
+                        action="store",
+                        default=1024,
+                        metavar="MB",
+                        type=int,
+                        help="maximum size of the token cache in megabytes (default: %(default)s)")
     parser.add_argument("--profile",
                         action="store_true",
                         help="profile compare50 (development only, requires line_profiler, implies debug)")
@@ -257,6 +426,8 @@ def main():
                         version=f"%(prog)s {__version__}")
 
     args = parser.parse_args()
+    if args.update_index and not args.archive_index:
+        parser.error("argument --update-index: requires --archive-index")
 
     excepthook.verbose = args.verbose
 
@@ -274,6 +445,11 @@ def main():
 
     preprocessor = _data.Preprocessor(passes[0].preprocessors)
 
+    if args.max_frequency is not None:
+        if not hasattr(passes[0].comparator, "max_frequency"):
+            raise _api.Error(f"compare50 ranks by pass {passes[0].__name__}, which does not support --max-frequency.")
+        passes[0].comparator.max_frequency = args.max_frequency
+
     if args.profile:
         args.debug = True
         profiler = profile
@@ -283,6 +459,9 @@ def main():
     if args.debug:
         _api.Executor = _api.FauxExecutor
 
+    if args.cache_dir:
+        _data.File.token_cache = _cache.TokenCache(args.cache_dir, max_size=args.cache_size * 2**20)
+
     if args.output.exists():
         try:
             resp = input(f"File path {termcolor.colored(args.output, None, attrs=['underline'])}"
@@ -305,32 +484,58 @@ def main():
         with _api.progress_bar("Preparing", total=total, disable=args.debug) as bar:
             # Collect all submissions, archive submissions and distro files
             subs = submission_factory.get_all(args.submissions, preprocessor)
-            archive_subs = submission_factory.get_all(args.archive, preprocessor, is_archive=True)
+            if args.update_index and not args.archive_index.exists():
+                archive_subs = comparators.ArchiveIndex.build([], passes[0])
+            elif args.archive_index:
+                archive_subs = comparators.ArchiveIndex.load(args.archive_index, preprocessor)
+                if archive_subs.pass_name != passes[0].__name__:
+                    raise _api.Error(f"{args.archive_index} was built for pass {archive_subs.pass_name},"
+                                     f" but compare50 ranks by pass {passes[0].__name__}.")
+            else:
+                archive_subs = submission_factory.get_all(args.archive, preprocessor, is_archive=True)
             ignored_subs = submission_factory.get_all(args.distro, preprocessor)
             ignored_files = {f for sub in ignored_subs for f in sub.files}
 
             if len(subs) + len(archive_subs) < 2:
                 raise _api.Error("At least two non-empty submissions are required for a comparison.")
 
+            # Rather than rank a resubmission against its own indexed copy, and only then refuse to index it
+            if args.update_index:
+                archive_subs.check_new(subs)
+
         print_stats(subs, archive_subs, ignored_files)
 
         with _api.progress_bar(f"Scoring ({passes[0].__name__})", disable=args.debug) as bar:
             # Cross compare and rank all submissions, keep only top `n`
-            scores = _api.rank(subs, archive_subs, ignored_files, passes[0], n=args.n)
-
-        # Get the matching spans, group them per submission
-        groups = []
-        pass_to_results = {}
-        for pass_ in passes:
-            with _api.progress_bar(f"Comparing ({pass_.__name__})", disable=args.debug):
-                preprocessor = _data.Preprocessor(pass_.preprocessors)
-                for sub in itertools.chain(subs, archive_subs, ignored_subs):
+            # If the archive index holds the ranking of earlier runs, only score the new pairs and merge them into it
+            ranking = getattr(archive_subs, "ranking", None) or ()
+            lsh = _data.LSH(*args.lsh) if args.lsh else None
+            scores = _api.rank(subs, archive_subs, ignored_files, passes[0], n=args.n, ranking=ranking, lsh=lsh)
+
+        if getattr(passes[0].comparator, "pruned", None) is not None:
+            print_prune_stats(passes[0].comparator.pruned, args.max_frequency)
+
+        # Prepare the comparisons of every pass, which then match the spans of each pair only as it is rendered
+        with _api.progress_bar("Preparing comparisons", disable=args.debug):
+            results = _api.compare_stream(scores, ignored_files, passes)
+
+        # Compare and render results, one submission pair at a time
+        with _api.progress_bar("Comparing and rendering", disable=args.debug), contextlib.closing(results):
+            index = _renderer.render(results, len(scores), dest=args.output, inline=args.inline)
+
+        if args.update_index:
+            with _api.progress_bar("Updating index", disable=args.debug):
+                # The index holds fingerprints of the pass compare50 ranks by
+                preprocessor = _data.Preprocessor(passes[0].preprocessors)
+                for sub in subs:
                     object.__setattr__(sub, "preprocessor", preprocessor)
-                pass_to_results[pass_] = _api.compare(scores, ignored_files, pass_)
+                archive_subs.ranking = scores
+                archive_subs.append(subs)
+                archive_subs.save(args.archive_index)
 
-        # Render results
-        with _api.progress_bar("Rendering", disable=args.debug):
-            index = _renderer.render(pass_to_results, dest=args.output)
+    if _data.File.token_cache is not None:
+        _data.File.token_cache.prune()
+        print_cache_stats(_data.File.token_cache)
 
     termcolor.cprint(
         f"Done! Visit file://{index.absolute()} in a web browser to see the results.", "green")
@@ -1,18 +1,21 @@
+import bisect
 import collections
 import contextlib
 import heapq
+import inspect
 import io
 import itertools
+import os
 import time
 
-import intervaltree
+import numpy as np
 import tqdm
 
 import concurrent.futures
-from ._data import Submission, Span, Group, BisectList, Compare50Result
+from ._data import File, Submission, Span, Group, Compare50Result, Preprocessor, TokenStream, _spans_by_file
 
 
-__all__ = ["rank", "compare", "missing_spans", "expand", "progress_bar", "get_progress_bar", "Error"]
+__all__ = ["rank", "compare", "compare_stream", "missing_spans", "expand", "maximal_matches", "progress_bar", "get_progress_bar", "Error"]
 
 
 class Error(Exception):
@@ -20,7 +23,7 @@ class Error(Exception):
     pass
 
 
-def rank(submissions, archive_submissions, ignored_files, pass_, n=50):
+def rank(submissions, archive_submissions, ignored_files, pass_, n=50, reserve=0, ranking=(), lsh=None):
     """
     :param submissions: submissions to be ranked
     :type submissions: [:class:`compare50.Submission`]
@@ -32,15 +35,30 @@ def rank(submissions, archive_submissions, ignored_files, pass_, n=50):
     :type pass_: :class:`compare50.Pass`
     :param n: number of submission pairs to return
     :type n: int
+    :param reserve: number of submission pairs the comparator should keep beyond ``n``
+    :type reserve: int
+    :param ranking: scores of an earlier ranking of ``archive_submissions`` to merge the new scores into
+    :type ranking: [:class:`compare50.Score`]
+    :param lsh: settings of locality-sensitive hashing, to score only the candidate pairs it proposes
+    :type lsh: :class:`compare50.LSH`
     :returns: the top ``n`` submission pairs
     :rtype: [:class:`compare50.Score`]
 
 
-    Rank submissions, return the top ``n`` most similar pairs
+    Rank submissions, return the top ``n`` most similar pairs. Given the ``ranking`` of an earlier run,
+    submissions are ranked incrementally (delta mode): only pairs of which at least one is one of
+    ``submissions`` are scored, after which their scores are merged into ``ranking``. Together with
+    an :class:`compare50.comparators.ArchiveIndex` as ``archive_submissions``, this takes time
+    proportional to the size of ``submissions`` rather than to that of the whole cohort.
+
+    Scoring every pair of a large cohort can take too long. Given ``lsh``, comparators that
+    support it score only the pairs that locality-sensitive hashing proposes, trading some
+    recall for speed (see :class:`compare50.LSH`).
     """
-    scores = pass_.comparator.score(submissions, archive_submissions, ignored_files)
+    # Let the comparator discard all but the top `n` (plus reserve) scores as it goes
+    scores = _score(pass_.comparator, submissions, archive_submissions, ignored_files, n=n + reserve, lsh=lsh)
     # Keep only top `n` submission matches
-    return heapq.nlargest(n, scores)
+    return heapq.nlargest(n, itertools.chain(ranking, scores))
 
     # max_id = max((max(score.sub_a.id, score.sub_b.id) for score in scores))
     # matrix = np.zeros((max_id+1, max_id+1))
@@ -52,6 +70,17 @@ def rank(submissions, archive_submissions, ignored_files, pass_, n=50):
         # object.__setattr__(submission, "cluster", int(labels[submission.id]))
 
 
+def _score(comparator, submissions, archive_submissions, ignored_files, **options):
+    """
+    Score the submissions with ``comparator``, passing it only those ``options`` its ``score`` accepts,
+    as comparators written before them take just the submissions and ignored files.
+    """
+    parameters = inspect.signature(comparator.score).parameters
+    if not any(parameter.kind == parameter.VAR_KEYWORD for parameter in parameters.values()):
+        options = {name: value for name, value in options.items() if name in parameters}
+    return comparator.score(submissions, archive_submissions, ignored_files, **options)
+
+
 def compare(scores, ignored_files, pass_):
     """
     :param scores: Scored submission pairs to be compared more granularly
@@ -67,40 +96,99 @@ def compare(scores, ignored_files, pass_):
     Performs an in-depth comparison of each submission pair and returns a corresponding
     list of :class:`compare50.compare50Result`\ s.
     """
+    return list(_compare(scores, ignored_files, pass_))
 
-    missing_spans_cache = {}
-    sub_match_to_ignored_spans = {}
-    sub_match_to_groups = {}
 
-    for comparison in pass_.comparator.compare(scores, ignored_files):
-        new_ignored_spans = []
-        for sub in (comparison.sub_a, comparison.sub_b):
-            for file in sub.files:
-                # Divide ignored_spans per file
-                ignored_spans_file = [span for span in comparison.ignored_spans
-                                           if span.file == file]
-
-                # Find all spans lost by preprocessors for file_a
-                if file not in missing_spans_cache:
-                    missing_spans_cache[file] = missing_spans(file)
-                ignored_spans_file.extend(missing_spans_cache[file])
+def compare_stream(scores, ignored_files, passes):
+    """
+    :param scores: Scored submission pairs to be compared more granularly
+    :type scores: [:class:`compare50.Score`]
+    :param ignored_files: files containing distro code
+    :type ignored_files: {:class:`compare50.File`}
+    :param passes: passes whose comparators should be used to compare the submissions
+    :type passes: [:class:`compare50.Pass`]
+    :returns: per submission pair, in the order of ``scores``, its :class:`compare50.Compare50Result`\ s \
+            of every pass
+    :rtype: iterator of [:class:`compare50.Compare50Result`]
 
-                # Flatten the spans (they could be overlapping)
-                new_ignored_spans += _flatten_spans(ignored_spans_file)
 
-        sub_match_to_ignored_spans[(comparison.sub_a, comparison.sub_b)] = new_ignored_spans
+    Like :func:`compare`, but for every pass at once, and lazily: the submission pairs are only
+    compared as the results are asked for, so that they need not all be held in memory. Sets the
+    preprocessor of the submissions to that of each pass in turn, so it is left at that of the last.
 
-        sub_match_to_groups[(comparison.sub_a, comparison.sub_b)] = _group_span_matches(comparison.span_matches)
+    Until the stream is exhausted or closed, every pass, as well as anything else that asks for an
+    executor without state in its workers (such as the renderer), shares a single pool of workers.
+    """
+    streams = []
+    subs = {sub for score in scores for sub in (score.sub_a, score.sub_b)} | {file.submission for file in ignored_files}
+    for pass_ in passes:
+        preprocessor = Preprocessor(pass_.preprocessors)
+        for sub in subs:
+            object.__setattr__(sub, "preprocessor", preprocessor)
+        streams.append(_compare(scores, ignored_files, pass_))
+
+    return _stream(streams)
+
+
+def _stream(streams):
+    """Generator of the results of every stream per submission pair, see :func:`compare_stream`."""
+    global _shared_executor
+
+    # Only start the workers once the stream is, as only then is it sure to shut them down.
+    # By then, every pass has shared what its workers need.
+    _shared_executor = _new_executor()
+    try:
+        for results in zip(*streams):
+            yield list(results)
+    finally:
+        # zip stops at the end of the first stream, so make the others clean up (their workers, say) right away
+        for stream in streams:
+            stream.close()
+        executor, _shared_executor = _shared_executor, None
+        executor.shutdown()
+
+
+def _compare(scores, ignored_files, pass_):
+    """
+    Start comparing the submission pairs of ``scores`` with the preprocessors the submissions have now,
+    return a generator of their :class:`compare50.Compare50Result`\ s, see :func:`compare`.
+    """
+    comparisons = pass_.comparator.compare(scores, ignored_files)
 
-    results = []
+    # Spans lost by preprocessors depend on the current preprocessors, so find them right away
+    file_to_missing_spans = {}
     for score in scores:
-        sub_match = (score.sub_a, score.sub_b)
-        results.append(Compare50Result(pass_,
-                                       score,
-                                       sub_match_to_groups.get(sub_match, []),
-                                       sub_match_to_ignored_spans[sub_match]))
+        for sub in (score.sub_a, score.sub_b):
+            for file in sub.files:
+                if file not in file_to_missing_spans:
+                    file_to_missing_spans[file] = missing_spans(file)
 
-    return results
+    return _results(scores, comparisons, file_to_missing_spans, pass_)
+
+
+def _results(scores, comparisons, file_to_missing_spans, pass_):
+    """Generator of the :class:`compare50.Compare50Result` of every score, given its :class:`compare50.Comparison`."""
+    # Ignored spans of a file are the same in every comparison, so flatten them once per file
+    file_to_ignored_spans = {}
+
+    try:
+        for score, comparison in zip(scores, comparisons):
+            # Comparators may also have set a plain list of spans
+            file_to_spans = _spans_by_file(comparison.ignored_spans)
+            ignored_spans = []
+            for sub in (comparison.sub_a, comparison.sub_b):
+                for file in sub.files:
+                    if file not in file_to_ignored_spans:
+                        # Add all spans lost by preprocessors, and flatten the spans (they could be overlapping)
+                        file_to_ignored_spans[file] = _flatten_spans(list(file_to_spans.get(file, []))
+                                                                     + file_to_missing_spans[file])
+                    ignored_spans += file_to_ignored_spans[file]
+
+            yield Compare50Result(pass_, score, _group_span_matches(comparison.span_matches), ignored_spans)
+    finally:
+        # Let lazy comparators clean up right away, rather than whenever they are garbage collected
+        if hasattr(comparisons, "close"):
+            comparisons.close()
 
 
 def missing_spans(file, original_tokens=None, processed_tokens=None):
@@ -123,7 +211,8 @@ def missing_spans(file, original_tokens=None, processed_tokens=None):
     if original_tokens is None:
         original_tokens = file.unprocessed_tokens()
     if processed_tokens is None:
-        processed_tokens = list(file.submission.preprocessor(original_tokens))
+        processed_tokens = file.submission.preprocessor(original_tokens)
+    processed_tokens = TokenStream.from_tokens(processed_tokens)
 
     if not original_tokens:
         return []
@@ -133,10 +222,10 @@ def missing_spans(file, original_tokens=None, processed_tokens=None):
 
     spans = []
     start = file_start
-    for token in processed_tokens:
-        if token.start != start:
-            spans.append(Span(file, start, token.start))
-        start = token.end
+    for token_start, token_end in zip(processed_tokens.starts, processed_tokens.ends):
+        if token_start != start:
+            spans.append(Span(file, start, token_start))
+        start = token_end
 
     if start < file_end:
         spans.append(Span(file, start, file_end))
@@ -152,10 +241,10 @@ def expand(span_matches, tokens_a, tokens_b):
     :type span_matches: [(:class:`compare50.Span`, :class:`compare50.Span`)]
     :param tokens_a: the tokens of the file corresponding to the first element of each \
             ``span_match``
-    :type tokens_a: [:class:`compare50.Token`]
+    :type tokens_a: :class:`compare50.TokenStream` or [:class:`compare50.Token`]
     :param tokens_b: :param tokens_a: the tokens of the file corresponding to the first \
             element of each ``span_match``
-    :type tokens_b: [:class:`compare50.Token`]
+    :type tokens_b: :class:`compare50.TokenStream` or [:class:`compare50.Token`]
     :returns: A new list of maximially expanded span pairs
     :rtype: [(:class:`compare50.Span`, :class:`compare50.Span`)]
 
@@ -167,76 +256,272 @@ def expand(span_matches, tokens_a, tokens_b):
     if not span_matches:
         return span_matches
 
-    expanded_span_matches = set()
-
-    # Keep a list of tokens, sorted by the start (BisectList facilitates binary search)
-    tokens_a = BisectList.from_sorted(tokens_a, key=lambda tok: tok.start)
-    tokens_b = BisectList.from_sorted(tokens_b, key=lambda tok: tok.start)
-
-    # Keep track of the intervals of the file covered by spans so that we can
-    # avoid expanding span pairs that are already subsumed
-    span_tree_a = intervaltree.IntervalTree()
-    span_tree_b = intervaltree.IntervalTree()
+    # Tokens are equal iff their (interned) types and values are, so compare them by a single key
+    tokens_a = TokenStream.from_tokens(tokens_a)
+    tokens_b = TokenStream.from_tokens(tokens_b)
+    keys_a = _token_keys(tokens_a)
+    keys_b = _token_keys(tokens_b)
 
     # Sort span matches first, to ensure that, if there are contiguous identical spans, we
     # start expanding the earliest span first.
-    span_matches = sorted(span_matches, key=lambda match: (match[0].start, match[1].start))
-
-    def is_subsumed(span, tree):
-        """Determine if span is contained by any interval in the tree.
-        Assumes that tree contains no intersecting intervals"""
-        intervals = tree[span.start:span.end]
-        for interval in intervals:
-            if span.start >= interval.begin and span.end <= interval.end:
-                return True
-        return False
-
-
-    def _expand_side(cursor_a, cursor_b, step):
-        """One-sided expansion. Given the start/end indices of a span pair,
-        expand token-wise moving along the list of tokens according to ``step``.
+    span_matches = list(span_matches)
+    columns = np.array([(span_a.start, span_a.end, span_b.start, span_b.end) for span_a, span_b in span_matches],
+                       dtype=np.int64)
+    order = np.lexsort((columns[:, 2], columns[:, 0]))
+    span_matches = [span_matches[i] for i in order.tolist()]
+    columns = columns[order].T
+    bounds = zip(*columns.tolist())
+
+    # Tokens are sorted by their start, so binary search the tokens of all spans at once.
+    # Expansion to the left starts at the token before a span, to the right at its last token.
+    lefts_a, rights_a = (np.searchsorted(np.frombuffer(tokens_a.starts, dtype=np.uint32),
+                                         columns[:2], side="right") - 2).tolist()
+    lefts_b, rights_b = (np.searchsorted(np.frombuffer(tokens_b.starts, dtype=np.uint32),
+                                         columns[2:], side="right") - 2).tolist()
+
+    # Keep track of the intervals of the files covered by expanded spans so that we can
+    # avoid expanding span pairs that are already subsumed. As spans are sorted, those in
+    # file a all start before the current one, which is thus subsumed iff it ends before
+    # the furthest of them (the frontier). Of those in file b, keep only the ones that are
+    # not subsumed by another, sorted by start (and thus by end, too).
+    frontier_a = -1
+    starts_b, ends_b = [], []
+
+    def is_subsumed_b(start, end):
+        i = bisect.bisect_right(starts_b, start)
+        return i > 0 and end <= ends_b[i - 1]
+
+    def add_b(start, end):
+        if is_subsumed_b(start, end):
+            return
+        # Replace the intervals that the new one subsumes
+        i = j = bisect.bisect_left(starts_b, start)
+        while j < len(ends_b) and ends_b[j] <= end:
+            j += 1
+        starts_b[i:j] = [start]
+        ends_b[i:j] = [end]
+
+    def _expand_side(tok_idx_a, tok_idx_b, step):
+        """One-sided expansion. Given the indices of the tokens to start from, expand
+        token-wise moving along the list of tokens according to ``step``.
 
         Returns a pair of indices corresponding to the new tokens"""
-
-        tok_idx_a = tokens_a.bisect_key_right(cursor_a) - 2
-        tok_idx_b = tokens_b.bisect_key_right(cursor_b) - 2
-
         try:
-            while min(tok_idx_a, tok_idx_b) >= 0 and tokens_a[tok_idx_a] == tokens_b[tok_idx_b]:
+            while min(tok_idx_a, tok_idx_b) >= 0 and keys_a[tok_idx_a] == keys_b[tok_idx_b]:
                 tok_idx_a += step
                 tok_idx_b += step
         except IndexError:
             pass
 
-        tok_idx_a -= step
-        tok_idx_b -= step
-
-        return tok_idx_a, tok_idx_b
-
+        return tok_idx_a - step, tok_idx_b - step
 
-    for span_a, span_b in span_matches:
-        if is_subsumed(span_a, span_tree_a) and is_subsumed(span_b, span_tree_b):
+    expanded_span_matches = {}
+    for (span_a, span_b), (start_a, end_a, start_b, end_b), left_a, right_a, left_b, right_b \
+            in zip(span_matches, bounds, lefts_a, rights_a, lefts_b, rights_b):
+        # Empty spans are never subsumed
+        if start_a < end_a <= frontier_a and start_b < end_b and is_subsumed_b(start_b, end_b):
             continue
 
         # Expand left
-        start_a, start_b = _expand_side(span_a.start, span_b.start, -1)
+        start_a, start_b = _expand_side(left_a, left_b, -1)
 
         # Expand right
-        end_a, end_b = _expand_side(span_a.end, span_b.end, 1)
+        end_a, end_b = _expand_side(right_a, right_b, 1)
 
-        new_span_a = Span(span_a.file, tokens_a[start_a].start, tokens_a[end_a].end)
-        new_span_b = Span(span_b.file, tokens_b[start_b].start, tokens_b[end_b].end)
+        new_span_a = Span(span_a.file, tokens_a.starts[start_a], tokens_a.ends[end_a])
+        new_span_b = Span(span_b.file, tokens_b.starts[start_b], tokens_b.ends[end_b])
 
-        span_tree_a.addi(new_span_a.start, new_span_a.end)
-        span_tree_b.addi(new_span_b.start, new_span_b.end)
+        frontier_a = max(frontier_a, new_span_a.end)
+        add_b(new_span_b.start, new_span_b.end)
 
         # Add new spans
-        expanded_span_matches.add((new_span_a, new_span_b))
+        expanded_span_matches[(new_span_a, new_span_b)] = None
 
-    # print(expanded_span_matches)
     return list(expanded_span_matches)
 
 
+def _token_keys(tokens):
+    """List of integers identifying the type and value of each token in a :class:`compare50.TokenStream`."""
+    type_ids = np.frombuffer(tokens.type_ids, dtype=np.uint32).astype(np.uint64)
+    return ((type_ids << np.uint64(32)) | np.frombuffer(tokens.val_ids, dtype=np.uint32)).tolist()
+
+
+def maximal_matches(file_a, tokens_a, file_b, tokens_b, k):
+    """
+    :param file_a: the file of ``tokens_a``
+    :type file_a: :class:`compare50.File`
+    :param tokens_a: tokens of ``file_a`` to be matched
+    :type tokens_a: :class:`compare50.TokenStream` or [:class:`compare50.Token`]
+    :param file_b: the file of ``tokens_b``
+    :type file_b: :class:`compare50.File`
+    :param tokens_b: tokens of ``file_b`` to be matched
+    :type tokens_b: :class:`compare50.TokenStream` or [:class:`compare50.Token`]
+    :param k: the minimum number of tokens in a match
+    :type k: int
+    :returns: span pairs of all maximal matches of at least ``k`` tokens
+    :rtype: [(:class:`compare50.Span`, :class:`compare50.Span`)]
+
+    Find every maximal run of at least ``k`` tokens with identical values shared by ``tokens_a``
+    and ``tokens_b``, that is, one that cannot be extended to the left or to the right, using a
+    suffix array of both token streams. Unlike :func:`compare50.expand`, this does not first
+    pair up every shared k-gram and grow each pair one token at a time, which makes it much
+    faster for files that share many k-grams, such as long near-identical or repetitive files.
+    Also unlike :func:`compare50.expand`, it returns matches both of whose spans lie within
+    other matches.
+    """
+    tokens_a = TokenStream.from_tokens(tokens_a)
+    tokens_b = TokenStream.from_tokens(tokens_b)
+    if min(len(tokens_a), len(tokens_b)) < k:
+        return []
+
+    # Tokens match iff their (interned) values do, as for the fingerprints of comparators
+    n_a = len(tokens_a)
+    _, ids = np.unique(np.concatenate((np.frombuffer(tokens_a.val_ids, dtype=np.uint32),
+                                       np.frombuffer(tokens_b.val_ids, dtype=np.uint32))), return_inverse=True)
+    # Text of tokens_a and tokens_b, each followed by a unique separator so that no match spans both
+    sep = ids.max() + 1
+    text = np.concatenate((ids[:n_a], [sep], ids[n_a:], [sep + 1])).astype(np.int64)
+    n = len(text)
+
+    # Build the suffix array by prefix doubling, where ranks[level] ranks the first 2^level
+    # tokens of every suffix (suffixes past the end of the text have rank -1)
+    ranks = [text]
+    suffix_array = np.argsort(text, kind="stable")
+    while True:
+        rank = ranks[-1]
+        h = 1 << (len(ranks) - 1)
+        if h >= n:
+            break
+        second = np.full(n, -1, dtype=np.int64)
+        second[:n - h] = rank[h:]
+        suffix_array = np.lexsort((second, rank))
+        new = np.ones(n, dtype=bool)
+        new[1:] = (rank[suffix_array[1:]] != rank[suffix_array[:-1]]) \
+                  | (second[suffix_array[1:]] != second[suffix_array[:-1]])
+        rank = np.empty(n, dtype=np.int64)
+        rank[suffix_array] = np.cumsum(new) - 1
+        ranks.append(rank)
+        if new.all():
+            break
+
+    def lcp(i, j):
+        """Length of the longest common prefixes of the suffixes at i and j (arrays)."""
+        i, j = i.copy(), j.copy()
+        length = np.zeros(len(i), dtype=np.int64)
+        # Separators are unique, so common prefixes never run past them (or the end)
+        for level in reversed(range(len(ranks))):
+            step = (ranks[level][i] == ranks[level][j]).astype(np.int64) << level
+            i += step
+            j += step
+            length += step
+        return length
+
+    # Suffixes that share their first k tokens are adjacent in the suffix array, in blocks
+    adjacent = lcp(suffix_array[:-1], suffix_array[1:])
+    block = np.zeros(n, dtype=np.int64)
+    block[1:] = np.cumsum(adjacent < k)
+    in_a = suffix_array < n_a
+    in_b = (suffix_array > n_a) & (suffix_array < n - 1)
+    counts_a = np.bincount(block[in_a], minlength=block[-1] + 1)
+    counts_b = np.bincount(block[in_b], minlength=block[-1] + 1)
+
+    # In blocks with few pairs of suffixes, simply pair up all of them and keep those that are maximal. A pair is
+    # a maximal match iff the tokens before it differ, as the separators before tokens_b (and, wrapping around,
+    # before tokens_a) are unique
+    small = counts_a * counts_b <= 4 * (counts_a + counts_b)
+    in_a &= small[block]
+    in_b &= small[block]
+    blocks_a, positions_a = block[in_a], suffix_array[in_a]
+    blocks_b, positions_b = block[in_b], suffix_array[in_b]
+    small_counts_b = np.bincount(blocks_b, minlength=block[-1] + 1)
+    firsts_b = np.cumsum(small_counts_b) - small_counts_b
+    repeats = small_counts_b[blocks_a]
+    starts_a = np.repeat(positions_a, repeats)
+    offsets = np.arange(len(starts_a)) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    starts_b = positions_b[np.repeat(firsts_b[blocks_a], repeats) + offsets]
+    left_maximal = text[starts_a - 1] != text[starts_b - 1]
+    starts_a, starts_b = starts_a[left_maximal], starts_b[left_maximal]
+    lengths = lcp(starts_a, starts_b)
+
+    # In the others (say, of repetitive files), most pairs are not maximal. There walk the tree of lcp intervals
+    # (the internal nodes of the suffix tree) bottom up instead, see Abouelhoda et al., "Replacing suffix trees
+    # with enhanced suffix arrays". Suffixes in different children of an interval share exactly its lcp tokens,
+    # so such a pair is maximal iff the tokens before them differ. Each node keeps its suffixes of either side
+    # grouped by the token before them, so that only the pairs that are maximal are ever visited.
+    large_blocks = np.flatnonzero(~small & (counts_a > 0) & (counts_b > 0))
+    block_firsts = np.searchsorted(block, large_blocks).tolist()
+    block_lasts = (np.searchsorted(block, large_blocks, side="right") - 1).tolist()
+    adjacent = adjacent.tolist()
+    positions = suffix_array.tolist()
+    lefts = text[suffix_array - 1].tolist()
+
+    matches_a, matches_b, match_lengths = [], [], []
+
+    def leaf(i):
+        position = positions[i]
+        if position < n_a:
+            return 1, {lefts[i]: [position]}, {}
+        if n_a < position < n - 1:
+            return 1, {}, {lefts[i]: [position]}
+        return 0, {}, {}
+
+    def merge(node, other, length):
+        """Report the maximal matches between the suffixes of two children of an interval, then merge them."""
+        if node[0] < other[0]:
+            node, other = other, node
+        size, node_a, node_b = node
+        _, other_a, other_b = other
+
+        # Pair the suffixes of either side of the smaller node with those of the other side of the larger one,
+        # going through the groups of the smaller node, so that merging all nodes takes O(n log n) steps
+        for groups, larger_groups, is_a in ((other_a, node_b, True), (other_b, node_a, False)):
+            if not larger_groups:
+                continue
+            for left, group in groups.items():
+                for larger_left, larger_group in larger_groups.items():
+                    if left != larger_left:
+                        group_a, group_b = (group, larger_group) if is_a else (larger_group, group)
+                        for position_a in group_a:
+                            matches_a.extend(itertools.repeat(position_a, len(group_b)))
+                            matches_b.extend(group_b)
+                        match_lengths.extend(itertools.repeat(length, len(group_a) * len(group_b)))
+
+        for groups, other_groups in ((node_a, other_a), (node_b, other_b)):
+            for left, group in other_groups.items():
+                groups.setdefault(left, []).extend(group)
+        return size + other[0], node_a, node_b
+
+    for first, last in zip(block_firsts, block_lasts):
+        # Stack of [lcp, node] of the intervals whose children are still being merged
+        stack = []
+        node = leaf(first)
+        for i in range(first + 1, last + 2):
+            length = adjacent[i - 1] if i <= last else 0
+            while stack and stack[-1][0] > length:
+                lcp_, top = stack.pop()
+                node = merge(top, node, lcp_)
+            if stack and stack[-1][0] == length:
+                stack[-1][1] = merge(stack[-1][1], node, length)
+            elif length >= k:
+                stack.append([length, node])
+            if i <= last:
+                node = leaf(i)
+
+    starts_a = np.concatenate((starts_a, np.array(matches_a, dtype=np.int64)))
+    starts_b = np.concatenate((starts_b, np.array(matches_b, dtype=np.int64)))
+    lengths = np.concatenate((lengths, np.array(match_lengths, dtype=np.int64)))
+    ends_a = starts_a + lengths - 1
+    ends_b = ends_a - starts_a + starts_b
+    starts_b -= n_a + 1
+    ends_b -= n_a + 1
+
+    order = np.lexsort((starts_b, starts_a))
+    return [(Span(file_a, tokens_a.starts[start_a], tokens_a.ends[end_a]),
+             Span(file_b, tokens_b.starts[start_b], tokens_b.ends[end_b]))
+            for start_a, end_a, start_b, end_b in zip(starts_a[order].tolist(), ends_a[order].tolist(),
+                                                      starts_b[order].tolist(), ends_b[order].tolist())]
+
+
 def _flatten_spans(spans):
     """
     Flatten a collection of spans.
@@ -277,62 +562,104 @@ def _group_span_matches(span_matches):
 
 
 def _transitive_closure(connections):
-    class Graph:
-        def __init__(self):
-            self.connections = collections.defaultdict(set)
-
-        def add(self, a, b):
-            self.connections[a].add(b)
-            self.connections[b].add(a)
-
-        def traverse(self, node, visited=None):
-            if visited is None:
-                visited = set()
-
-            visited.add(node)
-
-            for other_node in self.connections[node]:
-                if other_node not in visited:
-                    self.traverse(other_node, visited)
+    """
+    Partition the nodes of the graph whose edges are ``connections`` (pairs of nodes) into its
+    connected components, in order of their first appearance. Nodes are numbered and joined by
+    union-find (by size, with path halving), which takes close to linear time and no recursion.
+    """
+    ids = {}
+    parents = []
+    sizes = []
 
-            return visited
+    def find(id):
+        while parents[id] != id:
+            parents[id] = parents[parents[id]]
+            id = parents[id]
+        return id
 
-    graph = Graph()
     for a, b in connections:
-        graph.add(a, b)
-
-    trans_closure = []
-    nodes = graph.connections.keys()
-    while nodes:
-        node = next(iter(nodes))
-        reachable_nodes = graph.traverse(node)
-        nodes -= reachable_nodes
-        trans_closure.append(reachable_nodes)
-    return trans_closure
-
-
-def _is_span_subsumed(span, other_spans):
-    for other_span in other_spans:
-        if span.start >= other_span.start and span.end <= other_span.end:
-            return True
-    return False
-
-
-def _is_group_subsumed(group, groups):
-    for other_group in groups:
-        if other_group == group or len(other_group.spans) < len(group.spans):
+        root_a, root_b = ids.setdefault(a, len(ids)), ids.setdefault(b, len(ids))
+        # Every new node is a component of its own
+        while len(parents) < len(ids):
+            parents.append(len(parents))
+            sizes.append(1)
+
+        root_a, root_b = find(root_a), find(root_b)
+        if root_a == root_b:
             continue
+        if sizes[root_a] < sizes[root_b]:
+            root_a, root_b = root_b, root_a
+        parents[root_b] = root_a
+        sizes[root_a] += sizes[root_b]
 
-        for span in group.spans:
-            if not _is_span_subsumed(span, filter(lambda other: span.file == other.file, other_group.spans)):
-                break
-        else:
-            return True
-    return False
+    trans_closure = {}
+    for node, id in ids.items():
+        trans_closure.setdefault(find(id), set()).add(node)
+    return list(trans_closure.values())
 
 
 def _filter_subsumed_groups(groups):
-    return [g for g in groups if not _is_group_subsumed(g, groups)]
+    """
+    Drop every group of which each span is subsumed by a span (in the same file) of the same
+    other group, provided that group has at least as many spans. Rather than comparing every pair
+    of groups, look up the groups that subsume each span in an index of the spans of every file.
+    """
+    # Index the spans of each file by their start, along with the (index of the) group they're in
+    spans_by_file = {}
+    for i, group in enumerate(groups):
+        for span in group.spans:
+            spans_by_file.setdefault(span.file, []).append((span.start, span.end, i))
+
+    index = {}
+    for file, spans in spans_by_file.items():
+        spans.sort()
+        starts, ends, group_ids = (np.array(column, dtype=np.int64) for column in zip(*spans))
+
+        # Sparse table: argmax_table[j][i] is the position of the span that ends last among the 2^j from i on
+        argmax_table = [np.arange(len(spans))]
+        while 1 << len(argmax_table) <= len(spans):
+            previous, half = argmax_table[-1], 1 << (len(argmax_table) - 1)
+            left, right = previous[:-half], previous[half:]
+            argmax_table.append(np.where(ends[right] > ends[left], right, left))
+
+        index[file] = (starts.tolist(), ends.tolist(), group_ids.tolist(), [table.tolist() for table in argmax_table])
+
+    def subsuming_groups(span):
+        """Indices of the groups with a span that subsumes ``span``, in time proportional to those spans."""
+        starts, ends, group_ids, argmax_table = index[span.file]
+
+        # Of the spans that start no later, report the one that ends last as long as it ends no earlier,
+        # then look for more on either side of it
+        found = set()
+        ranges = [(0, bisect.bisect_right(starts, span.start))]
+        while ranges:
+            lo, hi = ranges.pop()
+            if lo >= hi:
+                continue
+            level = (hi - lo).bit_length() - 1
+            i, j = argmax_table[level][lo], argmax_table[level][hi - (1 << level)]
+            if ends[j] > ends[i]:
+                i = j
+            if ends[i] < span.end:
+                continue
+            found.add(group_ids[i])
+            ranges.append((lo, i))
+            ranges.append((i + 1, hi))
+        return found
+
+    def is_subsumed(group):
+        candidates = None
+        for span in group.spans:
+            if candidates is None:
+                candidates = {i for i in subsuming_groups(span)
+                              if len(groups[i].spans) >= len(group.spans) and groups[i] != group}
+            else:
+                candidates &= subsuming_groups(span)
+            if not candidates:
+                return False
+        return candidates is not None
+
+    return [g for g in groups if not is_subsumed(g)]
 
 
 class _ProgressBar:
@@ -441,8 +768,10 @@ class FauxExecutor:
         def add_done_callback(fn):
             fn()
 
-    def __init__(self, *_args, **_kwargs):
-        pass
+    def __init__(self, *_args, initializer=None, initargs=(), **_kwargs):
+        # Like a worker process would, run the initializer before any task
+        if initializer is not None:
+            initializer(*initargs)
 
     def map(self, fn, *iterables, **_kwargs):
         for iterable in iterables:
@@ -457,6 +786,9 @@ class FauxExecutor:
         else:
             return self.FauxFuture(result=result)
 
+    def shutdown(self, wait=True):
+        return
+
     def __enter__(self):
         return self
 
@@ -464,5 +796,75 @@ class FauxExecutor:
         return
 
 
+def _bounded_map(executor, fn, iterable, window=None):
+    """
+    Like ``executor.map(fn, iterable)``, but only ever submits ``window`` (by default twice the number
+    of CPUs) tasks ahead of the results consumed, so that neither ``iterable`` nor the results pile up.
+    """
+    window = window or 2 * (os.cpu_count() or 1)
+    pending = collections.deque()
+    for arg in iterable:
+        pending.append(executor.submit(fn, arg))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
 #: Executor used for concurrency
 Executor = concurrent.futures.ProcessPoolExecutor
+
+# Executor shared while compare_stream streams, see _executor
+_shared_executor = None
+
+# State of the worker processes, by key, see _share
+_worker_state = {}
+_worker_state_keys = itertools.count()
+
+
+def _share(state):
+    """
+    Share ``state`` with the workers of every executor started from now on (by :func:`_new_executor`),
+    so that it is sent to each worker once rather than with every task. Return its key in
+    :data:`_worker_state`, under which tasks find it, until it is no longer shared (see :func:`_unshare`).
+    """
+    key = next(_worker_state_keys)
+    _worker_state[key] = state
+    return key
+
+
+def _unshare(key):
+    """Stop sharing the state of ``key`` with the workers of executors started from now on."""
+    _worker_state.pop(key, None)
+
+
+def _init_worker(token_cache, state, initializer, initargs):
+    """Initializer of the worker processes of :func:`_new_executor`."""
+    # Workers need not have been forked (and so have the cache of this process) to use it
+    File.token_cache = token_cache
+    _worker_state.update(state)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _new_executor(initializer=None, initargs=()):
+    """
+    Start a new :data:`Executor`, whose workers have the token cache of :class:`compare50.File` and
+    the state shared (see :func:`_share`) so far, and run ``initializer(*initargs)`` too.
+    """
+    return Executor(initializer=_init_worker,
+                    initargs=(File.token_cache, dict(_worker_state), initializer, initargs))
+
+
+@contextlib.contextmanager
+def _executor():
+    """
+    Executor for tasks that need no state in the worker processes but what is shared (see :func:`_share`):
+    the one shared while :func:`compare_stream` streams, if any, otherwise a new one.
+    """
+    if _shared_executor is not None:
+        yield _shared_executor
+    else:
+        with _new_executor() as executor:
+            yield executor
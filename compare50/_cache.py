@@ -0,0 +1,175 @@
+import collections
+import hashlib
+import multiprocessing
+import os
+import pathlib
+import pickle
+import tempfile
+
+import pygments
+
+
+__all__ = ["TokenCache"]
+
+
+class TokenCache:
+    """
+    :param dir: directory in which cache entries are stored
+    :type dir: str or :class:`pathlib.Path`
+    :param max_size: maximum size of the cache in bytes
+    :type max_size: int
+
+    Persistent, content-addressed cache of tokens. Entries are keyed by the contents
+    of a file, the name of the lexer used to tokenize it and the chain of preprocessors
+    run on its tokens (as well as the versions of compare50 and pygments, whose lexers and
+    preprocessors may change), so that files that did not change between runs need not be
+    lexed or preprocessed again. Once the cache grows beyond ``max_size`` bytes,
+    the least recently used entries are evicted by :meth:`prune`.
+
+    Entries are unpickled, so ``dir`` must not be shared with or writable by other users.
+    Worker processes get the cache through their initializer, whichever way they are started,
+    and count their lookups in (shared memory of) the cache they were started with.
+    """
+    #: Bump whenever the format of cache entries changes
+    VERSION = 2
+
+    def __init__(self, dir, max_size=2**30):
+        self.dir = pathlib.Path(dir)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        # Shared memory, so that lookups in worker processes (see _api._new_executor) are counted too
+        self._hits = multiprocessing.Value("L", 0)
+        self._misses = multiprocessing.Value("L", 0)
+
+    @property
+    def hits(self):
+        """Number of successful lookups."""
+        return self._hits.value
+
+    @property
+    def misses(self):
+        """Number of failed lookups."""
+        return self._misses.value
+
+    @classmethod
+    def key(cls, text, lexer_name, preprocessors=()):
+        """
+        Compute the key of a file with contents ``text``, tokenized by lexer ``lexer_name``,
+        and preprocessed by ``preprocessors``. Returns ``None`` if a preprocessor cannot be
+        identified by name (e.g. lambdas), in which case its results should not be cached.
+        """
+        names = []
+        for preprocessor in preprocessors:
+            name = getattr(preprocessor, "__qualname__", None)
+            if name is None or "<" in name:
+                return None
+            names.append(f"{preprocessor.__module__}.{name}")
+
+        # Tokens may change with the code of compare50 and of pygments
+        from . import __version__
+
+        digest = hashlib.sha256()
+        for part in (str(cls.VERSION), __version__, pygments.__version__, lexer_name, *names):
+            digest.update(part.encode())
+            digest.update(b"\0")
+        digest.update(text.encode("utf-8", "surrogateescape"))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the object stored under ``key``, or ``None`` if there is no such entry."""
+        path = self.dir / key
+        try:
+            with open(path, "rb") as f:
+                obj = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            with self._misses.get_lock():
+                self._misses.value += 1
+            return None
+
+        # Mark entry as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        with self._hits.get_lock():
+            self._hits.value += 1
+        return obj
+
+    def put(self, key, obj):
+        """Store ``obj`` under ``key``."""
+        # Write to a temporary file first so that concurrent readers never see partial entries
+        fd, tmp = tempfile.mkstemp(dir=self.dir, prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.dir / key)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def prune(self):
+        """Evict least recently used entries until the cache is no larger than ``max_size``."""
+        entries = []
+        for path in self.dir.iterdir():
+            if path.name.startswith("."):
+                continue
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            size -= entry_size
+
+
+class TokenStore:
+    """
+    :param max_tokens: maximum number of tokens held by the store
+    :type max_tokens: int
+
+    Bounded, in-memory store of token streams. Once the store holds more than
+    ``max_tokens`` tokens, the least recently used streams are dropped.
+    """
+    def __init__(self, max_tokens=2**20):
+        self.max_tokens = max_tokens
+        self._streams = collections.OrderedDict()
+        self._size = 0
+
+    def get(self, key):
+        """Return the stream stored under ``key``, or ``None`` if there is no such stream."""
+        try:
+            self._streams.move_to_end(key)
+        except KeyError:
+            return None
+        return self._streams[key]
+
+    def put(self, key, stream):
+        """Store ``stream`` under ``key``, evicting least recently used streams if necessary."""
+        old = self._streams.pop(key, None)
+        if old is not None:
+            self._size -= len(old)
+
+        if len(stream) > self.max_tokens:
+            return
+
+        self._streams[key] = stream
+        self._size += len(stream)
+        while self._size > self.max_tokens:
+            _, evicted = self._streams.popitem(last=False)
+            self._size -= len(evicted)
+
+    def clear(self):
+        """Remove all streams from the store."""
+        self._streams.clear()
+        self._size = 0
@@ -1,16 +1,23 @@
 import abc
+import array
+import functools
+import hashlib
 from collections.abc import Mapping, Sequence
 import os
 import pathlib
 import numbers
 
 import attr
+import numpy as np
 import pygments
 import pygments.lexers
+from pygments.token import string_to_tokentype
+
+from ._cache import TokenStore
 
 
 __all__ = ["Pass", "Comparator", "File", "Submission",
-           "Pass", "Span", "Score", "Comparison", "Token"]
+           "Pass", "Span", "Score", "LSH", "Comparison", "Token", "TokenStream"]
 
 
 class _PassRegistry(abc.ABCMeta):
@@ -58,10 +65,14 @@ class Comparator(metaclass=abc.ABCMeta):
     should be scored and compared.
     """
     @abc.abstractmethod
-    def score(self, submissions, archive_submissions, ignored_files):
+    def score(self, submissions, archive_submissions, ignored_files, n=None, lsh=None):
         """
         Given a list of submissions, a list of archive submissions, and a set of distro
         files, return a list of :class:`compare50.Score`\ s for each submission pair.
+        If ``n`` is given, only the (at least) ``n`` highest scores need be returned,
+        with ties broken as :func:`heapq.nlargest` would. If ``lsh`` (:class:`compare50.LSH`)
+        is given, the comparator may score only the candidate pairs it proposes. Comparators
+        need not accept ``n`` or ``lsh``, in which case they are not given them.
         """
         pass
 
@@ -69,8 +80,10 @@ class Comparator(metaclass=abc.ABCMeta):
     def compare(self, scores, ignored_files):
         """
         Given a list of scores and a list of distro files, perform an in-depth
-        comparison of each submission pair and return a corresponding list of
-        :class:`compare50.Comparison`\ s
+        comparison of each submission pair and return a corresponding iterable of
+        :class:`compare50.Comparison`\ s, in the order of the scores. The iterable
+        may be lazy, but anything that depends on the preprocessors of the submissions
+        must be done before this returns, as they are swapped out for the next pass.
         """
         pass
 
@@ -148,6 +161,11 @@ class File:
     _lexer_cache = {}
     _store = IdStore(key=lambda file: file.path)
 
+    #: :class:`compare50.TokenCache` consulted before lexing/preprocessing, if any
+    token_cache = None
+    # Raw tokens of recently lexed files, shared by every pass
+    _raw_tokens = TokenStore()
+
     name = attr.ib(converter=pathlib.Path, cmp=False)
     submission = attr.ib(cmp=False)
     id = attr.ib(default=attr.Factory(lambda self: self._store[self], takes_self=True), init=False)
@@ -163,10 +181,16 @@ class File:
             return f.read(size)
 
     def tokens(self):
-        """Returns the preprpocessed tokens of the file."""
-        return list(self.submission.preprocessor(self.unprocessed_tokens()))
+        """Returns the preprpocessed tokens of the file as a :class:`compare50.TokenStream`."""
+        preprocessor = self.submission.preprocessor
+        text = self.read()
+        if self.token_cache is None or not isinstance(preprocessor, Preprocessor):
+            return TokenStream.from_tokens(preprocessor(self._unprocessed_tokens(text)))
+
+        return self._cached_tokens(text, preprocessor.preprocessors,
+                                   lambda: preprocessor(self._unprocessed_tokens(text)))
 
-    def lexer(self):
+    def lexer(self, text=None):
         """Determine which Pygments lexer should be used."""
         ext = self.name.suffix
         try:
@@ -181,7 +205,7 @@ class File:
             return lexer
         except pygments.util.ClassNotFound:
             try:
-                return pygments.lexers.guess_lexer(self.read())
+                return pygments.lexers.guess_lexer(self.read() if text is None else text)
             except pygments.util.ClassNotFound:
                 return pygments.lexers.special.TextLexer()
 
@@ -191,21 +215,54 @@ class File:
         return cls._store.objects[id]
 
     def unprocessed_tokens(self):
-        """Get the raw tokens of the file."""
-        text = self.read()
-        lexer_tokens = self.lexer().get_tokens_unprocessed(text)
-        tokens = []
+        """Get the raw tokens of the file as a :class:`compare50.TokenStream`."""
+        return self._unprocessed_tokens(self.read())
+
+    def _unprocessed_tokens(self, text):
+        # The lexer is determined by the file name, so key on it as well as on the contents
+        tokens = self._raw_tokens.get((self.name.name, text))
+        if tokens is not None:
+            return tokens
+
+        if self.token_cache is None:
+            tokens = self._lex(text)
+        else:
+            tokens = self._cached_tokens(text, (), lambda: self._lex(text))
+
+        self._put_unprocessed_tokens(tokens, text)
+        return tokens
+
+    def _put_unprocessed_tokens(self, tokens, text=None):
+        """Remember the raw ``tokens`` of the file, for instance those lexed by another process."""
+        text = self.read() if text is None else text
+        self._raw_tokens.put((self.name.name, text), tokens)
+
+    def _cached_tokens(self, text, preprocessors, compute):
+        """Look up the tokens resulting from running ``preprocessors`` on the file in
+        ``token_cache``. On a miss, ``compute`` them and store them."""
+        key = self.token_cache.key(text, self.lexer(text).name, preprocessors)
+        if key is None:
+            return compute()
+
+        tokens = self.token_cache.get(key)
+        if tokens is None:
+            tokens = compute()
+            self.token_cache.put(key, tokens)
+        return tokens
+
+    def _lex(self, text):
+        """Lex ``text`` into a :class:`compare50.TokenStream`."""
+        lexer_tokens = self.lexer(text).get_tokens_unprocessed(text)
+        tokens = TokenStream()
         prevToken = None
         for token in lexer_tokens:
             if prevToken:
-                tokens.append(Token(start=prevToken[0], end=token[0],
-                                    type=prevToken[1], val=prevToken[2]))
+                tokens.append(prevToken[0], token[0], prevToken[1], prevToken[2])
 
             prevToken = token
 
         if prevToken:
-            tokens.append(Token(start=prevToken[0], end=len(text),
-                                type=prevToken[1], val=prevToken[2]))
+            tokens.append(prevToken[0], len(text), prevToken[1], prevToken[2])
         return tokens
 
 
@@ -217,7 +274,7 @@ class Preprocessor:
     def __call__(self, tokens):
         for preprocessor in self.preprocessors:
             tokens = preprocessor(tokens)
-        return tokens
+        return TokenStream.from_tokens(tokens)
 
 
 @attr.s(slots=True, frozen=True, repr=False)
@@ -244,6 +301,17 @@ class Span:
         return self.file.read()[self.start:self.end]
 
 
+def _spans_by_file(spans):
+    """Map each file to its spans in ``spans``, unless already given such a mapping."""
+    if isinstance(spans, Mapping):
+        return spans
+
+    file_to_spans = {}
+    for span in spans:
+        file_to_spans.setdefault(span.file, []).append(span)
+    return file_to_spans
+
+
 @attr.s(slots=True)
 class Comparison:
     """
@@ -252,15 +320,17 @@ class Comparison:
     :ivar span_matches: a list of pairs of matching :class:`compare50.Span`\ s, wherein \
             the first element of each pair is from ``sub_a`` and the second is from \
             ``sub_b``.
-    :ivar ignored_spans: a list of :class:`compare50.Span`\ s which were ignored \
-            (e.g. because they matched distro files)
+    :ivar ignored_spans: a dict mapping each file of both submissions to a list of \
+            :class:`compare50.Span`\ s of it which were ignored (e.g. because they matched \
+            distro files). These should depend only on the file, not on the other submission. \
+            A plain list of spans (of any of the files) is accepted too, and grouped by file.
 
     Represents an in-depth comparison of two submissions.
     """
     sub_a = attr.ib(validator=attr.validators.instance_of(Submission))
     sub_b = attr.ib(validator=attr.validators.instance_of(Submission))
     span_matches = attr.ib(factory=list)
-    ignored_spans = attr.ib(factory=list)
+    ignored_spans = attr.ib(factory=dict, converter=_spans_by_file)
 
 
 @attr.s(slots=True)
@@ -278,6 +348,26 @@ class Score:
     score = attr.ib(default=0, validator=attr.validators.instance_of(numbers.Number))
 
 
+@attr.s(slots=True, frozen=True)
+class LSH:
+    """
+    :ivar bands: number of bands
+    :ivar rows: number of MinHashes per band
+    :ivar seed: seed of the (pseudo-random) MinHash functions
+
+    Settings of locality-sensitive hashing, which proposes candidate pairs of submissions so
+    that only these need be scored (see :func:`compare50.rank`). Every submission gets
+    ``bands * rows`` MinHashes of its fingerprints; two submissions are candidates if all
+    MinHashes of at least one band agree. Submissions whose sets of fingerprints have Jaccard
+    similarity s are thus candidates with probability ``1 - (1 - s ** rows) ** bands``, which
+    rises steeply around ``(1 / bands) ** (1 / rows)``. More bands or fewer rows trade speed
+    for recall.
+    """
+    bands = attr.ib(default=64, validator=attr.validators.instance_of(int))
+    rows = attr.ib(default=2, validator=attr.validators.instance_of(int))
+    seed = attr.ib(default=0, validator=attr.validators.instance_of(int))
+
+
 @attr.s(slots=True)
 class Compare50Result:
     """
@@ -364,6 +454,186 @@ class Token:
         return self.val == other.val and self.type == other.type
 
 
+class TokenStream(Sequence):
+    """
+    :ivar starts: array of the character indices at which each token begins
+    :ivar ends: array of the character indices one past the end of each token
+    :ivar type_ids: array of the interned Pygments token type of each token
+    :ivar val_ids: array of the interned string contents of each token
+
+    A compact, columnar sequence of tokens. Rather than one :class:`compare50.Token`
+    per lexeme, a stream keeps four parallel arrays. Token types and values are
+    interned, so two tokens are equal iff their type and value ids are.
+    Indexing (or iterating over) a stream produces fresh :class:`compare50.Token`\ s,
+    slicing produces a new stream.
+    """
+    __slots__ = ("starts", "ends", "type_ids", "val_ids")
+
+    def __init__(self, starts=(), ends=(), type_ids=(), val_ids=()):
+        self.starts = array.array("I", starts)
+        self.ends = array.array("I", ends)
+        self.type_ids = array.array("I", type_ids)
+        self.val_ids = array.array("I", val_ids)
+
+    @classmethod
+    def from_tokens(cls, tokens):
+        """Create a stream from an iterable of :class:`compare50.Token`\ s.
+        If ``tokens`` already is a stream, it is returned as is."""
+        if isinstance(tokens, TokenStream):
+            return tokens
+
+        stream = cls()
+        for tok in tokens:
+            stream.append(tok.start, tok.end, tok.type, tok.val)
+        return stream
+
+    @classmethod
+    def concatenate(cls, streams):
+        """Concatenate an iterable of streams into a single stream."""
+        result = cls()
+        for stream in streams:
+            result.extend(stream)
+        return result
+
+    def append(self, start, end, type, val):
+        """Add a token to the end of the stream."""
+        self.starts.append(start)
+        self.ends.append(end)
+        self.type_ids.append(_TYPES[type])
+        self.val_ids.append(_VALS[val])
+
+    def extend(self, other):
+        """Add the tokens of another stream to the end of this one."""
+        self.starts.extend(other.starts)
+        self.ends.extend(other.ends)
+        self.type_ids.extend(other.type_ids)
+        self.val_ids.extend(other.val_ids)
+
+    @property
+    def types(self):
+        """List of the Pygments token types of the tokens."""
+        types = _TYPES.objects
+        return [types[id] for id in self.type_ids]
+
+    @property
+    def vals(self):
+        """List of the string contents of the tokens."""
+        vals = _VALS.objects
+        return [vals[id] for id in self.val_ids]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            stream = TokenStream.__new__(TokenStream)
+            stream.starts = self.starts[idx]
+            stream.ends = self.ends[idx]
+            stream.type_ids = self.type_ids[idx]
+            stream.val_ids = self.val_ids[idx]
+            return stream
+
+        return Token(self.starts[idx], self.ends[idx],
+                     _TYPES.objects[self.type_ids[idx]], _VALS.objects[self.val_ids[idx]])
+
+    def __iter__(self):
+        types = _TYPES.objects
+        vals = _VALS.objects
+        for start, end, type_id, val_id in zip(self.starts, self.ends, self.type_ids, self.val_ids):
+            yield Token(start, end, types[type_id], vals[val_id])
+
+    def __add__(self, other):
+        return TokenStream.concatenate((self, TokenStream.from_tokens(other)))
+
+    def __radd__(self, other):
+        return TokenStream.concatenate((TokenStream.from_tokens(other), self))
+
+    def __eq__(self, other):
+        # Like Token.__eq__, only consider types and values
+        if isinstance(other, TokenStream):
+            return self.type_ids == other.type_ids and self.val_ids == other.val_ids
+        if isinstance(other, Sequence):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "TokenStream({})".format(list(self))
+
+    def __reduce__(self):
+        # Ids are only meaningful within this process, so ship the interned objects
+        # (types by name, as pickling Pygments types drags along the entire type tree)
+        type_ids, types = _localize(self.type_ids, _TYPES)
+        val_ids, vals = _localize(self.val_ids, _VALS)
+        return (_unpickle_stream, (self.starts, self.ends,
+                                   type_ids, [str(type) for type in types], val_ids, vals))
+
+
+# Interned token types and values, shared by all TokenStreams in this process
+_TYPES = IdStore()
+_VALS = IdStore()
+
+
+def stable_hash(val):
+    """
+    64-bit hash of the string ``val``. Unlike :func:`hash`, the result does not depend on
+    the process (or ``PYTHONHASHSEED``), so it may be stored and compared across runs and machines.
+    """
+    return int.from_bytes(hashlib.blake2b(val.encode("utf-8", "surrogatepass"), digest_size=8).digest(), "little")
+
+
+class Vocabulary:
+    """
+    :param hash: function from token values to integers
+
+    Run-wide table mapping token values to integers, so that sequences of tokens can be
+    hashed without building a string per sequence. Each value is mapped to its (stable)
+    hash rather than to e.g. a counter, so that every process (notably the workers of
+    :attr:`compare50._api.Executor`) maps the same value to the same integer.
+    """
+    def __init__(self, hash=stable_hash):
+        self._hash = hash
+        # Integer of each interned token value, indexed by its id in TokenStream.val_ids
+        self._table = np.empty(0, dtype=np.uint64)
+
+    def __call__(self, tokens):
+        """Map the value of each token in ``tokens`` to its integer, as an array of ``uint64``."""
+        table = self._table
+        if len(table) < len(_VALS):
+            new_vals = _VALS.objects[len(table):]
+            table = self._table = np.concatenate((table, np.fromiter(map(self._hash, new_vals),
+                                                                     dtype=np.uint64, count=len(new_vals))))
+        return table[np.asarray(TokenStream.from_tokens(tokens).val_ids, dtype=np.intp)]
+
+
+def _localize(ids, store):
+    """Renumber ``ids`` densely, return the new ids (in the narrowest array that fits them)
+    and the objects they correspond to."""
+    local = {}
+    local_ids = [local.setdefault(id, len(local)) for id in ids]
+    typecode = "B" if len(local) <= 2**8 else "H" if len(local) <= 2**16 else "I"
+    return array.array(typecode, local_ids), [store.objects[id] for id in local]
+
+
+def _unpickle_stream(starts, ends, type_ids, type_names, val_ids, vals):
+    types = [_TYPES[_tokentype(name)] for name in type_names]
+    vals = [_VALS[val] for val in vals]
+
+    stream = TokenStream.__new__(TokenStream)
+    stream.starts = starts
+    stream.ends = ends
+    stream.type_ids = array.array("I", [types[id] for id in type_ids])
+    stream.val_ids = array.array("I", [vals[id] for id in val_ids])
+    return stream
+
+
+@functools.lru_cache(maxsize=None)
+def _tokentype(name):
+    """Pygments token type corresponding to ``name`` (the result of ``str(type)``)."""
+    return string_to_tokentype(name)
+
+
 class BisectList(Sequence):
     """
     A sorted list allowing for easy binary seaching. This exists because Python's
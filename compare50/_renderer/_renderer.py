@@ -22,6 +22,13 @@ class Fragment:
     spans = attr.ib(default=attr.Factory(tuple), convert=tuple)
 
 
+@attr.s(slots=True)
+class Asset:
+    """A static file, either inlined (given its ``content``) or linked (by its ``href``)."""
+    href = attr.ib(default=None)
+    content = attr.ib(default=None)
+
+
 @attr.s(slots=True)
 class Data:
     name = attr.ib()
@@ -68,60 +75,73 @@ class HTMLSubmission:
             return 0
 
 
-def render(pass_to_results, dest):
+def render(results_per_sub_pair, num_sub_pairs, dest, inline=False):
+    """
+    Render a page per submission pair, as its results (those of every pass, the first of which
+    compare50 ranks by) come in, and an index of all pairs. Pairs should come in order of score,
+    highest first, as :func:`compare50.compare_stream` yields them for the ranked scores.
+
+    Static files (CSS and JavaScript) are written once to ``dest/static`` and linked from every
+    page, unless ``inline``, in which case they are inlined into every page instead, so that
+    each page is self-contained.
+    """
     bar = _api.get_progress_bar()
     dest = pathlib.Path(dest)
-
-    sub_pair_to_results = collections.defaultdict(list)
-    for results in pass_to_results.values():
-        for result in results:
-            sub_pair_to_results[(result.sub_a, result.sub_b)].append(result)
-
-    bar.reset(total=len(sub_pair_to_results) + 1)
-    # Sort by score
-    results_per_sub_pair = sorted(sub_pair_to_results.values(),
-                                  key=lambda res: res[0].score, reverse=True)
-
-    common_css = [read_file(STATIC / f) for f in  ("bootstrap.min.css", "fonts.css")]
-    match_css = common_css + [read_file(STATIC / "match.css")]
-    match_js = [read_file(STATIC / f) for f in ("split.min.js", "match.js")]
-    # Render all matches
-    with _api.Executor() as executor:
-        # Load static files
-        max_id = len(results_per_sub_pair)
-        for id, html in executor.map(_RenderTask(dest, max_id, match_js, match_css), enumerate(results_per_sub_pair, 1)):
+    dest.mkdir(exist_ok=True)
+
+    def assets(names):
+        if inline:
+            return [Asset(content=read_file(STATIC / name)) for name in names]
+
+        (dest / "static").mkdir(exist_ok=True)
+        for name in names:
+            shutil.copyfile(STATIC / name, dest / "static" / name)
+        return [Asset(href=f"static/{name}") for name in names]
+
+    bar.reset(total=num_sub_pairs + 1)
+
+    # Only hold on to the ranking scores of the pairs, for the index
+    scores = []
+    def ranked(results_per_sub_pair):
+        for id, results in enumerate(results_per_sub_pair, 1):
+            scores.append(results[0].score)
+            yield id, results
+
+    common_css = ("bootstrap.min.css", "fonts.css")
+    match_css = assets(common_css + ("match.css",))
+    match_js = assets(("split.min.js", "match.js"))
+    # Render all matches, writing each as soon as it is done
+    with _api._executor() as executor:
+        render_task = _RenderTask(dest, num_sub_pairs, match_js, match_css)
+        for id, html in _api._bounded_map(executor, render_task, ranked(results_per_sub_pair)):
             with open(dest / f"match_{id}.html", "w") as f:
                 f.write(html)
             bar.update()
 
-
     # Create index
     with open(TEMPLATES / "index.html") as f:
         index_template = jinja2.Template(
             f.read(), autoescape=jinja2.select_autoescape(enabled_extensions=("html",)))
 
-    ranking_pass, ranking_results = next(iter(pass_to_results.items()))
-
-
     try:
-        max_score = max((result.score.score for result in ranking_results))
+        max_score = max((score.score for score in scores))
     except ValueError:
         max_score = 0
 
     # Generate cluster data
     subs = set()
     graph_info = {"nodes": [], "links": [], "data": {}}
-    for i, result in enumerate(ranking_results):
-        graph_info["links"].append({"index":i, "source": str(result.sub_a.path), "target": str(result.sub_b.path), "value": 10 * result.score.score/max_score})
-        subs.add(result.sub_a)
-        subs.add(result.sub_b)
+    for i, score in enumerate(scores):
+        graph_info["links"].append({"index":i, "source": str(score.sub_a.path), "target": str(score.sub_b.path), "value": 10 * score.score/max_score})
+        subs.add(score.sub_a)
+        subs.add(score.sub_b)
 
     for sub in subs:
         graph_info["nodes"].append({"id": str(sub.path)})
         graph_info["data"][str(sub.path)] = {"is_archive": sub.is_archive}
 
-    index_css = common_css + [read_file(STATIC / "index.css")]
-    index_js = [read_file(STATIC / f) for f in ("d3.v4.min.js", "d3-scale-chromatic.v1.min.js", "d3-simple-slider.js", "index.js")]
+    index_css = assets(common_css + ("index.css",))
+    index_js = assets(("d3.v4.min.js", "d3-scale-chromatic.v1.min.js", "d3-simple-slider.js", "index.js"))
     # Render index
     rendered_index = index_template.render(js=index_js,
                                            css=index_css,
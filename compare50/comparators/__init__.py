@@ -1,2 +1,2 @@
-from ._winnowing import Winnowing
+from ._winnowing import Winnowing, ArchiveIndex
 from ._misspellings import Misspellings
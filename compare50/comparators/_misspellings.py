@@ -1,5 +1,6 @@
 import collections
 import contextlib
+import heapq
 import itertools
 import pathlib
 import re
@@ -17,27 +18,31 @@ class Misspellings(Comparator):
 
     def _misspelled(self, *files):
         """Returns a set containing all of the words in each file that are not in the dictionary"""
-        return set().union(*({tok.val for tok in file.tokens() if tok.val not in self.dictionary} for file in files))
+        return set().union(*({val for val in file.tokens().vals if val not in self.dictionary} for file in files))
 
-    def score(self, submissions, archive_submissions, ignored_files):
+    def score(self, submissions, archive_submissions, ignored_files, n=None, lsh=None):
         """Number of identically misspelled words."""
         ignored_words = self._misspelled(*ignored_files)
 
         # Map each submission to its misspelled words
         sub_to_words = {sub: self._misspelled(*sub) - ignored_words for sub in submissions}
 
-        # For each pair of submissions, assign a score based upon number of misspelled words
-        scores = [Score(sub_a, sub_b, _intersect_size(words_a, words_b))
-                    for (sub_a, words_a), (sub_b, words_b) in itertools.combinations(sub_to_words.items(), r=2)]
+        def scores():
+            # For each pair of submissions, assign a score based upon number of misspelled words
+            for (sub_a, words_a), (sub_b, words_b) in itertools.combinations(sub_to_words.items(), r=2):
+                yield Score(sub_a, sub_b, _intersect_size(words_a, words_b))
 
-        # Compare each archive submission against each regular submission
-        for archive_sub in archive_submissions:
-            # Find all misspelled words in archive
-            archive_words = self._misspelled(*archive_sub) - ignored_words
-            scores.extend(Score(sub, archive_sub, _intersect_size(words, archive_words))
-                            for sub, words in sub_to_words.items())
+            # Compare each archive submission against each regular submission
+            for archive_sub in archive_submissions:
+                # Find all misspelled words in archive
+                archive_words = self._misspelled(*archive_sub) - ignored_words
+                for sub, words in sub_to_words.items():
+                    yield Score(sub, archive_sub, _intersect_size(words, archive_words))
 
-        return scores
+        # Only ever hold on to the top n scores
+        if n is not None:
+            return heapq.nlargest(n, scores())
+        return list(scores())
 
     def compare(self, scores, ignored_files):
         ignored_words = self._misspelled(*ignored_files)
@@ -49,19 +54,18 @@ class Misspellings(Comparator):
         spellcheck_results = {file: self._spellcheck(file, ignored_words)
                                 for sub in subs
                                     for file in sub}
-        comparisons = []
+        return self._comparisons(scores, spellcheck_results)
+
+    def _comparisons(self, scores, spellcheck_results):
         for score in scores:
             span_matches = []
-            ignored_spans = set()
             for file_a, file_b in itertools.product(score.sub_a.files, score.sub_b.files):
                 results_a, results_b = spellcheck_results[file_a], spellcheck_results[file_b]
-
-                ignored_spans.update(results_a.correct, results_b.correct)
                 span_matches.extend(results_a.match_misspellings(results_b))
 
-            comparisons.append(Comparison(score.sub_a, score.sub_b,
-                                          span_matches, list(ignored_spans)))
-        return comparisons
+            ignored_spans = {file: spellcheck_results[file].correct
+                             for file in itertools.chain(score.sub_a.files, score.sub_b.files)}
+            yield Comparison(score.sub_a, score.sub_b, span_matches, ignored_spans)
 
     def _spellcheck(self, file, ignored_words):
         word_to_spans = collections.defaultdict(list)
@@ -1,14 +1,20 @@
 import abc
-import collections
+import collections.abc
 import itertools
+import json
 import math
+import os
+import pathlib
 import sys
+import time
+import weakref
 
 import attr
 import numpy as np
 
 
-from .. import _api, Comparison, Comparator, Submission, Span, Score
+from .. import _api, Comparison, Comparator, Submission, Span, Score, TokenStream
+from .._data import Vocabulary
 
 
 class Winnowing(Comparator):
@@ -18,137 +24,456 @@ class Winnowing(Comparator):
     :type t: int
     :parma k: the noise threshold; any matching sequence of tokens shorter than this will be ignored
     :type k: int
+    :param rolling: whether to hash k-grams with a rolling (Rabin-Karp) hash, which takes \
+            O(log n) rather than O(k) vectorized steps per file. Either way, the hashes are the same.
+    :type rolling: bool
+    :param max_frequency: when scoring, skip fingerprints that occur in more than this many files, \
+            or, if a float, in more than this fraction of the number of submissions. Boilerplate \
+            shared by m submissions costs m^2 work, yet barely adds to scores. Skips nothing by default.
+    :type max_frequency: int or float
+    :param suffix_array: whether to find matching spans in :meth:`compare` with a suffix array \
+            of both files (see :func:`compare50.maximal_matches`) rather than by expanding every \
+            pair of matching k-grams. This is faster for long, near-identical files, and also \
+            finds the matches that expanding skips because both of their spans lie within others.
+    :type suffix_array: bool
     """
 
-    __slots__ = ["k", "t"]
+    __slots__ = ["k", "t", "rolling", "max_frequency", "suffix_array", "pruned"]
 
-    def __init__(self, k, t):
+    def __init__(self, k, t, rolling=True, max_frequency=None, suffix_array=False):
         self.k = k
         self.t = t
+        self.rolling = rolling
+        self.max_frequency = max_frequency
+        self.suffix_array = suffix_array
+        #: :class:`Pruned` fingerprints of the last call to :meth:`score`, if any were skipped
+        self.pruned = None
 
-    def score(self, submissions, archive_submissions, ignored_files):
+    def score(self, submissions, archive_submissions, ignored_files, n=None, lsh=None):
         """Number of matching k-grams."""
         def files(subs):
             return [f for sub in subs for f in sub]
 
-        submission_index = ScoreIndex(self.k, self.t)
-        archive_index = ScoreIndex(self.k, self.t)
-        ignored_index = ScoreIndex(self.k, self.t)
+        # Archive submissions whose fingerprints are stored in an index need not be fingerprinted again
+        archive = archive_submissions if isinstance(archive_submissions, ArchiveIndex) \
+                                         and archive_submissions.matches(self) else None
 
         submission_files = files(submissions)
-        archive_files = files(archive_submissions)
+        archive_files = [] if archive else files(archive_submissions)
 
         bar = _api.get_progress_bar()
         bar.reset(total=math.ceil((len(submission_files) + len(archive_files) + len(ignored_files)) / 0.9))
-        frequency_map = collections.Counter()
-        with _api.Executor() as executor:
-            # Subs and archive subs
-            for index, files in ((submission_index, submission_files), (archive_index, archive_files)):
-                for idx in executor.map(self._index_file(ScoreIndex, (self.k, self.t)), files):
-                    for hash_ in idx.keys():
-                        frequency_map[hash_] += 1
-                    index.include_all(idx)
-                    bar.update()
-            # Ignored files
-            for idx in executor.map(self._index_file(ScoreIndex, (self.k, self.t)), ignored_files):
-                index.include_all(idx)
-                bar.update()
+        with _api._new_executor() as executor:
+            ignored_index, _ = self._index_files(executor, ignored_files)
+
+        # Send ignored fingerprints to every worker once, so that workers drop them before sending back the rest
+        with _api._new_executor(initializer=_set_ignored_hashes, initargs=(ignored_index.keys(),)) as executor:
+            submission_index, submission_hashes = self._index_files(executor, submission_files, ignore=True)
+            if archive:
+                # Indexed archive submissions still have their ignored fingerprints, but these match no submission
+                archive_indices, archive_frequencies = archive.indices(), archive.frequencies()
+            else:
+                archive_index, archive_hashes = self._index_files(executor, archive_files, ignore=True)
+                archive_indices, archive_frequencies = [archive_index], [_count(archive_hashes)]
+
+        # Number of (sub or archive sub) files each hash occurs in
+        frequencies = [_count(submission_hashes)] + archive_frequencies
+        N = len(submissions) + len(archive_submissions)
+
+        def frequency(hashes):
+            return sum(_lookup(table, hashes) for table in frequencies)
+
+        def score(hashes):
+            return 1 + np.log(N / (1 + frequency(hashes)))
+
+        # Every comparison is against the submissions, so skipping a fingerprint need only drop it from them
+        others = [submission_index] + archive_indices
+        self.pruned = None
+        if self.max_frequency is not None:
+            keys = submission_index.keys()
+            if isinstance(self.max_frequency, float):
+                # A fraction of the submissions, so count the submissions (entries in the indices) of every hash
+                counts = sum(_lookup(index._postings()[::2], keys) for index in others)
+                pruned_hashes = keys[counts > self.max_frequency * N]
+            else:
+                pruned_hashes = keys[frequency(keys) > self.max_frequency]
+            total_pairs = _n_pairs(submission_index, others, keys)
+            self.pruned = Pruned(fingerprints=len(pruned_hashes),
+                                 pairs=_n_pairs(submission_index, others, pruned_hashes),
+                                 postings=submission_index._drop(pruned_hashes))
+
+        # Compare submissions against submissions and archive submissions (the Indices we're going to compare against)
+        start = time.perf_counter()
+        if lsh is not None:
+            scores = self._score_candidates(submission_index, others, score, n, lsh)
+        else:
+            scores = submission_index.compare(*others, score=score, n=n)
+
+        if self.pruned is not None and total_pairs > self.pruned.pairs:
+            # Estimate the time skipped pairs would have taken from the time the others took
+            elapsed = time.perf_counter() - start
+            self.pruned.seconds = elapsed * self.pruned.pairs / (total_pairs - self.pruned.pairs)
+        return scores
+
+    def _score_candidates(self, submission_index, indices, score, n, lsh):
+        """
+        Score only those pairs of submissions (at least one of which from ``submission_index``)
+        that locality-sensitive hashing of the MinHash signatures of their fingerprints proposes.
+        """
+        bar = _api.get_progress_bar()
 
+        # Number the submissions in all indices 0, 1, ... in order of their ids
+        hashes = np.concatenate([index._hashes for index in indices])
+        ids, local_ids = np.unique(np.concatenate([index._ids_at(slice(None)) for index in indices]),
+                                   return_inverse=True)
+        if not len(ids):
+            return []
 
-        submission_index.ignore_all(ignored_index)
-        archive_index.ignore_all(ignored_index)
+        signatures = _minhashes(hashes, local_ids, lsh.bands * lsh.rows, seed=lsh.seed)
+        ids1, ids2 = _lsh_candidates(signatures, lsh.bands, lsh.rows)
+        bar.update((bar.total - bar.n) / 2)
 
-        # Add submissions to archive (the Index we're going to compare against)
-        archive_index.include_all(submission_index)
+        # Archive submissions are not compared against each other
+        is_submission = np.isin(ids, submission_index._ids_at(slice(None)))
+        keep = is_submission[ids1] | is_submission[ids2]
+        ids1, ids2 = ids1[keep], ids2[keep]
 
-        N = len(submissions) + len(archive_submissions)
-        return submission_index.compare(archive_index, score=lambda h: 1 + math.log(N / (1 + frequency_map[h])))
+        scores = _PairScores(int(ids[-1]) + 1)
+        scores.add(ids[ids1], ids[ids2], _pair_totals(hashes, local_ids, ids1, ids2, score))
+        bar.update(bar.total - bar.n - 1)
+
+        ids1, ids2, totals = scores.totals(n)
+        return [Score(Submission.get(id1), Submission.get(id2), total)
+                for id1, id2, total in zip(ids1.tolist(), ids2.tolist(), totals.tolist())]
+
+    def _index_files(self, executor, files, ignore=False):
+        """
+        Fingerprint every file in parallel and merge the fingerprints of all files in one go.
+        Return the merged index and the (unique) hashes of each file. If ``ignore``, the workers
+        of ``executor`` drop the hashes set by :func:`_set_ignored_hashes`.
+        """
+        bar = _api.get_progress_bar()
+        file_hashes = []
+        for hashes in executor.map(self._fingerprint_file((self.k, self.t, self.rolling), ignore), files):
+            file_hashes.append(hashes)
+            bar.update()
+
+        # Workers only send back hashes, the id of each is that of the submission of its file
+        ids = np.repeat(np.array([file.submission.id for file in files], dtype=np.int64),
+                        [len(hashes) for hashes in file_hashes])
+        index = ScoreIndex(self.k, self.t, self.rolling)
+        index._merge([index._hashes] + file_hashes, [index._ids, ids])
+        index._max_id = int(ids.max()) if len(ids) else 0
+        return index, file_hashes
 
     def compare(self, scores, ignored_files):
+        """
+        Tokenize every file (with the preprocessor of its submission) right away, then return a
+        generator that matches the pairs of submissions as the comparisons are asked for.
+        """
+        # Find all unique files
+        files = {file.id: file for score in scores for sub in (score.sub_a, score.sub_b) for file in sub}
 
         bar = _api.get_progress_bar()
-        bar.reset(total=len(scores) if scores else 1)
+        bar.reset(total=len(files) + len(scores) if scores else 1)
         if not scores:
             return []
 
         # Create index of ignored_files
-        ignored_index = CompareIndex(self.k)
+        ignored_index = CompareIndex(self.k, self.rolling)
         for ignored_file in ignored_files:
             ignored_index.include(ignored_file)
 
-        # Find all unique submissions
-        subs = set()
-        for s in scores:
-            subs.add(s.sub_a)
-            subs.add(s.sub_b)
+        # Tokenize every file once, in parallel
+        file_cache = {}
+        try:
+            with _api._new_executor(initializer=_set_compare_state, initargs=({"ignored_index": ignored_index},)) as executor:
+                for file, (cache, raw_tokens) in zip(files.values(), executor.map(_cache_file, files.values())):
+                    # Keep the raw tokens too, so that they need not be lexed again (by later passes, say)
+                    file._put_unprocessed_tokens(raw_tokens)
+                    file_cache[file.id] = cache
+                    bar.update()
+        finally:
+            _compare_state.clear()
+
+        # The ignored spans of every file, in terms of our own files
+        ignored_spans = {id: [Span(files[id], span.start, span.end) for span in cache.ignored_spans]
+                         for id, cache in file_cache.items()}
+
+        # Send the caches to every worker once, rather than those of a pair with every task.
+        # They are shared until the comparisons are done with, even if never asked for.
+        key = _api._share(file_cache)
+        comparisons = self._comparisons(scores, files, key, ignored_spans, bar)
+        weakref.finalize(comparisons, _api._unshare, key)
+        return comparisons
+
+    def _comparisons(self, scores, files, key, ignored_spans, bar):
+        """
+        Generator of the :class:`compare50.Comparison` of every score, see :meth:`compare`, given the key
+        under which the caches of the files are shared with the workers. Counts every comparison on ``bar``
+        only while it is the current progress bar, as the comparisons may well be asked for after it is
+        closed (by a renderer, say, with a bar of its own).
+        """
+        # Match every pair of submissions in parallel. Tasks carry only the ids of their pair's files,
+        # so that any executor that has the shared caches will do, even one shared with other passes
+        with _api._executor() as executor:
+            file_ids = (([file.id for file in score.sub_a], [file.id for file in score.sub_b]) for score in scores)
+            matches_per_score = _api._bounded_map(executor,
+                                                  self._match_files(self.k, self.rolling, self.suffix_array, key),
+                                                  file_ids)
+            for score, matches in zip(scores, matches_per_score):
+                span_matches = [(Span(files[id_a], start_a, end_a), Span(files[id_b], start_b, end_b))
+                                for id_a, start_a, end_a, id_b, start_b, end_b in matches]
+
+                # We already have the ignored spans for every file, so we just need to pick those of this pair
+                yield Comparison(score.sub_a, score.sub_b, span_matches,
+                                 {file: ignored_spans[file.id]
+                                  for file in itertools.chain(score.sub_a.files, score.sub_b.files)})
+                if _api.get_progress_bar() is bar:
+                    bar.update()
+
+    @attr.s(slots=True)
+    class _fingerprint_file:
+        """ "Function" that fingerprints a file and returns its unique hashes, as a sorted array.
+        In the form of a class so that pickle can serialize it. """
+        args = attr.ib(default=())
+        ignore = attr.ib(default=False)
 
-        # TODO: Rename me
-        # Basically a named tuple of information we need to keep around for each file
-        @attr.s(slots=True)
-        class FileCache:
-            # List of tokens (and their corresponding indices) that can be matched.
-            # Name is slightly misleading since it is a list of (token, index) pairs
-            unignored_tokens = attr.ib(factory=list)
-            ignored_spans = attr.ib(factory=list)
+        def __call__(self, file):
+            hashes = np.unique(ScoreIndex(*self.args)._fingerprint_hashes(file))
+            if self.ignore:
+                hashes = np.delete(hashes, _intersect(hashes, _ignored_hashes)[0])
+            return hashes
 
+    @attr.s(slots=True)
+    class _match_files:
+        """ "Function" that finds the matching spans of two submissions, given the ids of their files,
+        whose :class:`_FileCache`\ s are shared with the worker under ``key``. Returns them as tuples of
+        the file id, start and end of both spans, so that they are cheap to send back. In the form of a
+        class so that pickle can serialize it. """
+        k = attr.ib()
+        rolling = attr.ib()
+        suffix_array = attr.ib()
+        key = attr.ib()
+
+        def __call__(self, file_ids):
+            k, rolling = self.k, self.rolling
+            file_cache = _api._worker_state[self.key]
+            caches = [[file_cache[id] for id in ids] for ids in file_ids]
+            matches = []
 
-        file_cache = {}
-        for sub in subs:
-            for file in sub:
-                file_tokens = file.tokens()
-                cache = FileCache()
+            # Compare each pair of files in the submission pair
+            for cache_a, cache_b in itertools.product(*caches):
+                if self.suffix_array:
+                    # For each pair of unignored regions in the file pair, find the maximal matches directly
+                    span_matches = (span_match for tokens_a, tokens_b in itertools.product(cache_a.unignored_tokens,
+                                                                                           cache_b.unignored_tokens)
+                                    for span_match in _api.maximal_matches(cache_a.file, tokens_a,
+                                                                           cache_b.file, tokens_b, k))
+                else:
+                    # For each pair of unignored regions in the file pair, find the matching spans
+                    # (by comparing their indices) and expand them as much as possible
+                    span_matches = (span_match for (tokens_a, index_a), (tokens_b, index_b)
+                                    in itertools.product(cache_a.indices(k, rolling), cache_b.indices(k, rolling))
+                                    for span_match in _api.expand(index_a.compare(index_b), tokens_a, tokens_b))
+
+                for span_a, span_b in span_matches:
+                    matches.append((span_a.file.id, span_a.start, span_a.end,
+                                    span_b.file.id, span_b.start, span_b.end))
+            return matches
+
+
+@attr.s(slots=True)
+class Pruned:
+    """Fingerprints :class:`Winnowing` skipped when scoring, because they occur too often."""
+    #: Number of distinct fingerprints (hashes) skipped
+    fingerprints = attr.ib()
+    #: Number of entries (pairs of a hash and a submission) of these in the index of the submissions
+    postings = attr.ib()
+    #: Number of pairs of postings skipping them saved going through
+    pairs = attr.ib()
+    #: Estimate of the time that saved, in seconds
+    seconds = attr.ib(default=0.0)
+
+
+# Integers identifying token values, shared by all indices in this process
+_vocabulary = Vocabulary()
+
+@attr.s(slots=True)
+class _FileCache:
+    """What :meth:`Winnowing.compare` keeps around for each file."""
+    file = attr.ib()
+    # List of token streams that can be matched
+    unignored_tokens = attr.ib(factory=list)
+    ignored_spans = attr.ib(factory=list)
+    # Pairs of these token streams and their index, built (once) by the process that needs them
+    _indices = attr.ib(default=None)
+
+    def __getstate__(self):
+        # Indices are cheaper to rebuild than to send to another process
+        return self.file, self.unignored_tokens, self.ignored_spans
+
+    def __setstate__(self, state):
+        self.file, self.unignored_tokens, self.ignored_spans = state
+        self._indices = None
+
+    def indices(self, k, rolling):
+        """Return the list of pairs of unignored token streams and their :class:`CompareIndex`."""
+        if self._indices is None:
+            self._indices = []
+            for token_list in self.unignored_tokens:
+                index = CompareIndex(k, rolling)
+                index.include(self.file, tokens=token_list)
+                self._indices.append((token_list, index))
+        return self._indices
+
+
+# State shared by the tasks of Winnowing.compare in a worker process, see _set_compare_state
+_compare_state = {}
+
+
+def _set_compare_state(state):
+    """Initializer of worker processes of :meth:`Winnowing.compare`."""
+    _compare_state.update(state)
+
+
+def _cache_file(file):
+    """
+    Tokenize a file, return its :class:`_FileCache` and its raw tokens, given the index of
+    ignored files in the state of this process.
+    """
+    file_tokens = file.tokens()
 
-                # Get list of unignored tokens
-                token_lists = ignored_index.unignored_tokens(file, tokens=file_tokens)
-                # Index each stretch of unignored tokens, index and add to the cache
-                for token_list in token_lists:
-                    index = CompareIndex(self.k)
-                    index.include(file, tokens=token_list)
-                    cache.unignored_tokens.append((token_list, index))
+    # Get list of unignored tokens
+    token_lists = _compare_state["ignored_index"].unignored_tokens(file, tokens=file_tokens)
+    ignored_spans = _api.missing_spans(file,
+                                       original_tokens=file_tokens,
+                                       processed_tokens=TokenStream.concatenate(token_lists))
+    return _FileCache(file, token_lists, ignored_spans), file.unprocessed_tokens()
 
-                cache.ignored_spans = _api.missing_spans(file,
-                                                         original_tokens=file_tokens,
-                                                         processed_tokens=list(itertools.chain.from_iterable(token_lists)))
-                file_cache[file] = cache
 
+# Sorted array of hashes that workers drop from fingerprints, see _set_ignored_hashes
+_ignored_hashes = np.empty(0, dtype=np.uint64)
 
 
-        comparisons = []
-        for score in scores:
-            ignored_spans = set()
-            span_matches = []
+def _set_ignored_hashes(hashes):
+    """Initializer of worker processes, sets the (sorted) hashes to drop from fingerprints."""
+    global _ignored_hashes
+    _ignored_hashes = hashes
 
-            # We already have the ignored spans for every file cached, so we just need to get the list
-            # for each file in this submission pair.
-            for file in itertools.chain(score.sub_a.files, score.sub_b.files):
-                ignored_spans.update(file_cache[file].ignored_spans)
 
-            # Compare each pair of files in the submission pair
-            for file_a, file_b in itertools.product(score.sub_a.files, score.sub_b.files):
-                cache_a = file_cache[file_a]
-                cache_b = file_cache[file_b]
-                # For each pair of unignored regions in the file pair, find the matching spans
-                # (by comparing their indices) and expand them as much as possible
-                for (tokens_a, index_a), (tokens_b, index_b) in itertools.product(cache_a.unignored_tokens, cache_b.unignored_tokens):
-                    span_matches += _api.expand(index_a.compare(index_b), tokens_a, tokens_b)
-
-            comparisons.append(Comparison(score.sub_a, score.sub_b, span_matches, list(ignored_spans)))
-            bar.update()
+# Base of the polynomial hash; hashes are computed modulo 2^64 by letting uint64 arithmetic wrap
+_BASE = 0x100000001b3
 
-        return comparisons
 
+def _power(exponent):
+    """_BASE ** exponent modulo 2^64, as a uint64."""
+    return np.uint64(pow(_BASE, exponent, 2**64))
 
-    @attr.s(slots=True)
-    class _index_file:
-        """ "Function" that indexes a file and returns the index.
-        In the form of a class so that pickle can serialize it. """
-        index = attr.ib()
-        args = attr.ib(default=())
 
-        def __call__(self, file):
-            index = self.index(*self.args)
-            index.include(file)
-            return index
+def _count(hash_arrays):
+    """Return the unique hashes in a list of arrays and the number of arrays each occurs in (if unique per array)."""
+    return np.unique(np.concatenate([np.empty(0, dtype=np.uint64)] + hash_arrays), return_counts=True)
+
+
+def _n_pairs(index, others, hashes):
+    """Number of pairs of postings ``index.compare(*others)`` goes through for (unique, sorted) ``hashes``."""
+    counts = _lookup(index._postings()[::2], hashes)
+    return sum(int(np.dot(counts, _lookup(other._postings()[::2], hashes))) for other in others)
+
+
+def _minhashes(hashes, ids, n_functions, seed=0):
+    """
+    Return the MinHash signatures of the sets of hashes of ids 0, 1, ..., ``ids.max()`` (each of
+    which must have a hash), as an array of ``n_functions`` rows and a column per id.
+    """
+    # x -> a * x + b (mod 2^64) is a permutation of the hashes for odd a
+    rand = np.random.RandomState(seed)
+    multipliers = np.frombuffer(rand.bytes(8 * n_functions), dtype=np.uint64) | np.uint64(1)
+    offsets = np.frombuffer(rand.bytes(8 * n_functions), dtype=np.uint64)
+
+    order = np.argsort(ids, kind="stable")
+    hashes, ids = hashes[order], ids[order]
+    starts = np.r_[0, np.flatnonzero(ids[1:] != ids[:-1]) + 1]
+
+    signatures = np.empty((n_functions, len(starts)), dtype=np.uint64)
+    for i in range(n_functions):
+        signatures[i] = np.minimum.reduceat(hashes * multipliers[i] + offsets[i], starts)
+    return signatures
+
+
+def _lsh_candidates(signatures, bands, rows):
+    """
+    Return the pairs of ids (columns of ``signatures``) ``id1 < id2`` whose signatures agree
+    on every row of at least one band of ``rows`` rows, as two arrays.
+    """
+    n_ids = signatures.shape[1]
+    candidates = [np.empty(0, dtype=np.int64)]
+    for band in range(bands):
+        # Hash the rows of the band into a single key per id
+        keys = np.zeros(n_ids, dtype=np.uint64)
+        for row in signatures[band * rows:(band + 1) * rows]:
+            keys = keys * np.uint64(_BASE) + row
+
+        # Ids with the same key form a bucket, every pair of ids in a bucket is a candidate
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        bounds = np.r_[0, np.flatnonzero(keys[1:] != keys[:-1]) + 1, n_ids]
+        starts, counts = bounds[:-1], np.diff(bounds)
+        starts, counts = starts[counts > 1], counts[counts > 1]
+
+        positions1, positions2 = _products(starts, counts, starts, counts)
+        upper = positions1 < positions2
+        # Buckets are in order of id (the sort is stable), so order[positions1] < order[positions2]
+        candidates.append(order[positions1[upper]] * n_ids + order[positions2[upper]])
+    return np.divmod(np.unique(np.concatenate(candidates)), n_ids)
+
+
+def _pair_totals(hashes, ids, ids1, ids2, score):
+    """
+    Return the total score (``score`` maps an array of hashes to their scores) of the hashes
+    that ``ids1[i]`` and ``ids2[i]`` have in common, for every ``i``, given parallel arrays
+    ``hashes`` and ``ids`` in which every hash occurs at most once per id.
+    """
+    totals = np.zeros(len(ids1))
+    if not len(ids1):
+        return totals
+
+    # Sort the hashes of every id, and score every hash once
+    order = np.lexsort((hashes, ids))
+    hashes = hashes[order]
+    counts = np.bincount(ids)
+    starts = np.cumsum(counts) - counts
+    unique, inverse = np.unique(hashes, return_inverse=True)
+    weights = score(unique)[inverse.ravel()]
+
+    # Go through the pairs by first id, looking up the hashes of all second ids in those of the first
+    order = np.argsort(ids1, kind="stable")
+    ids1, ids2 = ids1[order], ids2[order]
+    bounds = np.r_[0, np.flatnonzero(ids1[1:] != ids1[:-1]) + 1, len(ids1)]
+    for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+        own = hashes[starts[ids1[start]]:starts[ids1[start]] + counts[ids1[start]]]
+        positions = _ranges(starts[ids2[start:end]], counts[ids2[start:end]])
+        others = hashes[positions]
+        common = own[np.minimum(np.searchsorted(own, others), len(own) - 1)] == others
+
+        tags = np.repeat(np.arange(end - start), counts[ids2[start:end]])
+        totals[order[start:end]] = np.bincount(tags[common], weights=weights[positions[common]], minlength=end - start)
+    return totals
+
+
+def _ranges(starts, counts):
+    """Return the concatenation of ranges ``[starts[i], starts[i] + counts[i])``."""
+    ends = np.cumsum(counts)
+    return np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - (ends - counts), counts)
+
+
+def _lookup(table, hashes):
+    """Look up the counts of ``hashes`` in a table of sorted unique hashes and their counts, 0 if absent."""
+    counts = np.zeros(len(hashes), dtype=np.int64)
+    found, positions = _intersect(hashes, table[0])
+    counts[found] = table[1][positions]
+    return counts
 
 
 class Index(abc.ABC):
@@ -157,32 +482,11 @@ class Index(abc.ABC):
     :param k: the size of the fingerprints, or equivalently the "noise threshold", the \
               number of tokens that must be identical between two files for us to consider
               it a match.
+    :param rolling: whether to hash k-grams with a rolling hash (see :meth:`rolling_hashes`)
     """
-    def __init__(self, k):
+    def __init__(self, k, rolling=True):
         self.k = k
-        self._index = collections.defaultdict(set)
-
-    def keys(self):
-        return self._index.keys()
-
-    def values(self):
-        return self._index.values()
-
-    def include(self, file, tokens=None):
-        """Fingerprint a file and add it too the index."""
-        for hash, val in self.fingerprint(file, tokens):
-            self._index[hash].add(val)
-
-    def include_all(self, other):
-        """Add all fingerprints from another index into this one."""
-        for hash, vals in other._index.items():
-            self._index[hash] |= vals
-        return self
-
-    def ignore_all(self, other):
-        """Remove all fingerprints in another index from this one."""
-        for hash in other._index:
-            self._index.pop(hash, None)
+        self.rolling = rolling
 
     def kgrams(self, iterable):
         """
@@ -195,8 +499,55 @@ class Index(abc.ABC):
         return zip(*iters)
 
     def hashes(self, tokens):
-        """Hash each contiguous sequence of k tokens in ``tokens``."""
-        return (hash("".join(kgram)) for kgram in self.kgrams(t.val for t in tokens))
+        """
+        Hash each contiguous sequence of k tokens in ``tokens``, returning an array of
+        ``uint64``. The hashes depend only on the values of the tokens, so they are identical
+        across processes and runs.
+        """
+        # Hash k-grams of integers (see Vocabulary) rather than joining k strings per k-gram
+        ids = _vocabulary(tokens)
+        if self.rolling:
+            return self.rolling_hashes(ids)
+        return self.polynomial_hashes(ids)
+
+    def polynomial_hashes(self, ids):
+        """
+        Hash each contiguous sequence of k integers in the array ``ids`` with a polynomial
+        hash modulo 2^64, by evaluating all k-grams at once with Horner's method (k
+        vectorized steps).
+        """
+        n = len(ids) - self.k + 1
+        if n <= 0:
+            return np.empty(0, dtype=np.uint64)
+
+        base = _power(1)
+        hashes = np.zeros(n, dtype=np.uint64)
+        for i in range(self.k):
+            hashes *= base
+            hashes += ids[i:i + n]
+        return hashes
+
+    def rolling_hashes(self, ids):
+        """
+        Same hashes as :meth:`polynomial_hashes`, derived from the prefix hashes
+        ``prefix[i] = prefix[i - 1] * _BASE + ids[i]`` (Rabin-Karp) instead. The prefix hashes
+        are computed with a parallel scan in log2(len(ids)) vectorized steps, independent of k.
+        """
+        k = self.k
+        n = len(ids) - k + 1
+        if n <= 0:
+            return np.empty(0, dtype=np.uint64)
+
+        prefix = np.array(ids, dtype=np.uint64)
+        step = 1
+        while step < len(prefix):
+            prefix[step:] += prefix[:-step] * _power(step)
+            step *= 2
+
+        # hash of ids[i:i + k] is prefix[i + k - 1] - prefix[i - 1] * _BASE^k
+        hashes = prefix[k - 1:]
+        hashes[1:] -= prefix[:n - 1] * _power(k)
+        return hashes
 
     @abc.abstractmethod
     def compare(self, other):
@@ -206,56 +557,158 @@ class Index(abc.ABC):
     def fingerprint(self, file, tokens=None):
         pass
 
-    def __bool__(self):
-        return bool(self._index)
+    @abc.abstractmethod
+    def include(self, file, tokens=None):
+        """Fingerprint a file and add it to the index."""
+        pass
+
+    @abc.abstractmethod
+    def include_all(self, other):
+        """Add all fingerprints from another index into this one."""
+        pass
+
+    @abc.abstractmethod
+    def ignore_all(self, other):
+        """Remove all fingerprints in another index from this one."""
+        pass
 
 
 class ScoreIndex(Index):
-    def __init__(self, k, t):
-        super().__init__(k)
+    """
+    Index of the fingerprints of files to the ids of the submissions they come from, stored as
+    parallel arrays of hashes and ids, sorted by hash and then by id. Compared to a mapping of
+    hashes to sets of ids, this takes a fraction of the memory and lets indices be merged and
+    intersected in bulk.
+    """
+    def __init__(self, k, t, rolling=True):
+        super().__init__(k, rolling)
         self.w = t - k + 1
         self._max_id = 0
+        self._hashes = np.empty(0, dtype=np.uint64)
+        self._ids = np.empty(0, dtype=np.int64)
+        # Maps the ids in _ids to submission ids, if set (so that ids need not all be renumbered up front)
+        self._id_map = None
+        # Cached result of _postings
+        self._runs = None
 
-    def include(self, file, tokens=None):
-        super().include(file, tokens)
-        self._max_id = max(self._max_id, file.submission.id)
-
-    def include_all(self, other):
-        super().include_all(other)
-        self._max_id = max(self._max_id, other._max_id)
+    def keys(self):
+        """Unique hashes in the index, as a sorted array."""
+        return self._postings()[0]
 
-    def compare(self, other, score=lambda _: 1):
-        # Keep a self.max_file_id by other.max_file_id matrix for counting score
-        scores = np.zeros((self._max_id + 1, other._max_id + 1), dtype=np.float64)
+    def include(self, file, tokens=None):
+        hashes = self._fingerprint_hashes(file, tokens)
+        id = file.submission.id
+        self._merge([self._hashes, hashes], [self._ids_at(slice(None)), np.full(len(hashes), id, dtype=np.int64)])
+        self._max_id = max(self._max_id, id)
+
+    def include_all(self, *others):
+        """Add all fingerprints from other indices into this one, merging them all in one pass."""
+        indices = (self,) + others
+        self._merge([index._hashes for index in indices], [index._ids_at(slice(None)) for index in indices])
+        self._max_id = max(index._max_id for index in indices)
+        return self
 
-        # Find common fingerprints (hashes)
-        common_hashes = set(self._index) & set(other._index)
+    def ignore_all(self, other):
+        self._drop(other.keys())
+
+    def _drop(self, keys):
+        """Remove all entries of the (sorted) hashes ``keys``, return the number of entries removed."""
+        # Find the run of each hash in this index
+        lows = np.searchsorted(self._hashes, keys, side="left")
+        highs = np.searchsorted(self._hashes, keys, side="right")
+        if np.array_equal(lows, highs):
+            return 0
+
+        # Drop every entry inside a run
+        depth = np.zeros(len(self._hashes) + 1, dtype=np.int64)
+        np.add.at(depth, lows, 1)
+        np.add.at(depth, highs, -1)
+        keep = np.cumsum(depth[:-1]) == 0
+        n_dropped = len(self._hashes) - int(np.count_nonzero(keep))
+        self._hashes, self._ids = self._hashes[keep], self._ids[keep]
+        self._runs = None
+        return n_dropped
+
+    def compare(self, *others, score=None, n=None, chunk_size=2**20):
+        """
+        Score every pair of submissions (one from this index, the other from one of ``others``)
+        that share fingerprints. ``score`` maps an array of hashes to an array of the scores of
+        the corresponding fingerprints, by default every fingerprint scores 1. Comparing
+        against several indices (with disjoint ids) is the same as comparing against their
+        union, without having to merge them.
+        """
+        # Sparse accumulator of the scores of pairs of ids, only pairs that share a fingerprint take up memory
+        scores = _PairScores(max(other._max_id for other in others) + 1, chunk_size=chunk_size)
+        hashes1, starts1, counts1 = self._postings()
 
         bar = _api.get_progress_bar()
         try:
-            update_amount = (bar.total - bar.n - 1) / len(common_hashes)
+            update_amount = (bar.total - bar.n - 1) / len(others)
         except ZeroDivisionError:
             pass
 
-        for hash_ in common_hashes:
-            bar.update(update_amount)
-
-            # All file_ids associated with fingerprint in self
-            index1 = self._index[hash_]
-            # All file_ids associated with fingerprint in other
-            index2 = other._index[hash_]
-            if index1 and index2:
-                # Create the product of all file_ids from self and other
-                # https://stackoverflow.com/questions/28684492/numpy-equivalent-of-itertools-product
-                index = np.array(np.meshgrid([id for id in index1],
-                                             [id for id in index2])).T.reshape(-1, 2)
-
-                # Add 1 to all combo's (the product) of file_ids from self and other
-                scores[index[:, 0], index[:, 1]] += score(hash_)
+        for other in others:
+            # Find common fingerprints (hashes) by looking up the sorted hashes of self in other
+            hashes2, starts2, counts2 = other._postings()
+            common1, common2 = _intersect(hashes1, hashes2)
+            common_hashes = hashes1[common1]
+            weights = np.ones(len(common_hashes)) if score is None else score(common_hashes)
+
+            # Number of pairs of ids (the product of their postings) each common hash adds to
+            n_pairs = counts1[common1] * counts2[common2]
+            ends = np.cumsum(n_pairs)
+
+            # Score the products of postings in chunks of common hashes of about chunk_size pairs
+            start = 0
+            while start < len(common_hashes):
+                offset = ends[start - 1] if start else 0
+                end = max(start + 1, np.searchsorted(ends, offset + chunk_size, side="right"))
+                chunk = slice(start, end)
+
+                positions1, positions2 = _products(starts1[common1[chunk]], counts1[common1[chunk]],
+                                                   starts2[common2[chunk]], counts2[common2[chunk]])
+                scores.add(self._ids_at(positions1), other._ids_at(positions2), np.repeat(weights[chunk], n_pairs[chunk]))
+
+                bar.update(update_amount * (end - start) / len(common_hashes))
+                start = end
+
+        # Return only those (top n) Scores with a score > 0 from different submissions
+        ids1, ids2, totals = scores.totals(n)
+        return [Score(Submission.get(id1), Submission.get(id2), total)
+                for id1, id2, total in zip(ids1.tolist(), ids2.tolist(), totals.tolist())]
+
+    def _merge(self, hashes, ids):
+        """Replace the contents of the index by the concatenation of arrays ``hashes`` and ``ids``."""
+        hashes = np.concatenate(hashes)
+        ids = np.concatenate(ids)
+
+        # Sort by hash, then by id, and drop duplicate entries
+        order = np.lexsort((ids, hashes))
+        hashes, ids = hashes[order], ids[order]
+        unique = np.ones(len(hashes), dtype=bool)
+        np.logical_or(hashes[1:] != hashes[:-1], ids[1:] != ids[:-1], out=unique[1:])
+        self._hashes, self._ids = hashes[unique], ids[unique]
+        self._id_map = None
+        self._runs = None
+
+    def _ids_at(self, positions):
+        """Submission ids at ``positions`` in the index."""
+        ids = self._ids[positions]
+        return ids if self._id_map is None else self._id_map[ids]
+
+    def _postings(self):
+        """Return the unique hashes in the index and the start and length of each one's run of ids."""
+        if self._runs is None:
+            hashes = self._hashes
+            first = np.ones(len(hashes), dtype=bool)
+            np.not_equal(hashes[1:], hashes[:-1], out=first[1:])
+            starts = np.flatnonzero(first)
+            counts = np.diff(np.append(starts, len(hashes)))
+            self._runs = hashes[starts], starts, counts
+        return self._runs
 
-        # Return only those Scores with a score > 0 from different submissions
-        return [Score(Submission.get(id1), Submission.get(id2), scores[id1][id2])
-                for id1, id2 in zip(*np.where(np.triu(scores, 1) > 0))]
+    def __bool__(self):
+        return bool(len(self._hashes))
 
     def fingerprint(self, file, tokens=None):
         if not tokens:
@@ -263,32 +716,193 @@ class ScoreIndex(Index):
             if not tokens:
                 return []
 
+        id = file.submission.id
+        return [(hash_, id) for hash_ in self._fingerprint_hashes(file, tokens).tolist()]
+
+    def _fingerprint_hashes(self, file, tokens=None):
+        """Fingerprint a file, return the array of selected hashes."""
+        if not tokens:
+            tokens = file.tokens()
+            if not tokens:
+                return np.empty(0, dtype=np.uint64)
+
         hashes = self.hashes(tokens)
+        return hashes[self.winnow(hashes)]
 
-        fingerprints = []
+    def winnow(self, hashes):
+        """
+        Select positions in ``hashes`` by robust winnowing: in every window of w consecutive
+        hashes the minimum is selected, preferring the previously selected position on ties.
+        Should that position leave the window, the rightmost minimum is selected instead.
+        """
+        m = len(hashes)
+        w = self.w
+        if m == 0:
+            return []
 
-        # circular buffer holding window
-        buf = [(math.inf, Span(None, 0, 0))] * self.w
-        # index of minimum hash in buffer
-        min_idx = 0
-        for hash_, idx in zip(hashes, itertools.cycle(range(self.w))):
-            buf[idx] = hash_, file.submission.id
-            if min_idx == idx:
-                # old min not in window, search left for new min
-                for j in range(1, self.w):
-                    search_idx = (idx - j) % self.w
-                    if buf[search_idx][0] < buf[min_idx][0]:
-                        min_idx = search_idx
-                fingerprints.append(buf[min_idx])
-            else:
-                # compare new hash to old min (robust winnowing)
-                if buf[idx][0] < buf[min_idx][0]:
-                    min_idx = idx
-                    fingerprints.append(buf[min_idx])
-        return fingerprints
+        # Rightmost minimum of each window hashes[pos - w + 1:pos + 1], in O(m) steps (van Herk/Gil-Werman):
+        # split the hashes, padded on the left with the largest hash (which is never the rightmost minimum),
+        # into blocks of w. Every window then consists of the end of one block and the start of the next
+        num_blocks = -(-(m + w - 1) // w)
+        padded = np.full(num_blocks * w, np.iinfo(np.uint64).max, dtype=np.uint64)
+        padded[w - 1:w - 1 + m] = hashes
+        blocks = padded.reshape(num_blocks, w)
+        indices = np.arange(num_blocks * w).reshape(num_blocks, w)
+
+        # Rightmost minimum of the start of each block, up to each position: the last minimum so far
+        prefix_mins = np.minimum.accumulate(blocks, axis=1)
+        prefix_args = np.maximum.accumulate(np.where(blocks == prefix_mins, indices, -1), axis=1).ravel()
+
+        # Rightmost minimum of the end of each block, from each position on: where its minimum last is the minimum
+        suffix_mins = np.minimum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1]
+        last = np.ones((num_blocks, w), dtype=bool)
+        last[:, :-1] = suffix_mins[:, :-1] != suffix_mins[:, 1:]
+        suffix_args = np.minimum.accumulate(np.where(last, indices, num_blocks * w)[:, ::-1], axis=1)[:, ::-1].ravel()
+
+        # On ties, the minimum of the start of the next block is the rightmost
+        ends = np.arange(w - 1, m + w - 1)
+        prefix_args, suffix_args = prefix_args[ends], suffix_args[ends - w + 1]
+        rightmost_min = np.where(padded[prefix_args] <= padded[suffix_args], prefix_args, suffix_args) - (w - 1)
+
+        # A hash smaller than all w hashes before it is always selected: it either replaces
+        # the current minimum, or that minimum just expired and it is the new minimum
+        smaller = np.empty(m, dtype=bool)
+        smaller[0] = True
+        np.less(hashes[1:], hashes[rightmost_min[:-1]], out=smaller[1:])
+        new_mins = np.flatnonzero(smaller).tolist()
+        new_mins.append(m)
+
+        # In between, the selected position only changes when it expires
+        rightmost_min = rightmost_min.tolist()
+        positions = []
+        for pos, next_min in zip(new_mins, new_mins[1:]):
+            positions.append(pos)
+            while pos + w < next_min:
+                pos = rightmost_min[pos + w]
+                positions.append(pos)
+        return positions
+
+
+class _PairScores:
+    """
+    :param stride: upper bound (exclusive) on the ids in the second element of a pair
+    :param chunk_size: number of pending additions after which they are summed up
+
+    Sparse accumulator of the scores of pairs of ids ``(id1, id2)`` with ``id1 < id2``
+    (other pairs are ignored). Pairs are packed into a single integer key ``id1 * stride + id2``,
+    and additions are buffered and summed up in chunks by :func:`numpy.bincount`. Memory is proportional to
+    the number of pairs that have a score, rather than to the square of the largest id.
+    """
+    def __init__(self, stride, chunk_size=2**20):
+        self.stride = stride
+        self.chunk_size = chunk_size
+        # Unique keys (sorted) and their summed scores
+        self._keys = np.empty(0, dtype=np.int64)
+        self._scores = np.empty(0, dtype=np.float64)
+        # Pending additions, arrays of keys and their scores
+        self._pending_keys = []
+        self._pending_scores = []
+        self._n_pending = 0
+
+    def add(self, ids1, ids2, scores):
+        """Add ``scores[i]`` to the score of pair ``(ids1[i], ids2[i])`` for every ``i``."""
+        ordered = ids1 < ids2
+        keys = ids1[ordered] * self.stride + ids2[ordered]
+        if not len(keys):
+            return
+
+        self._pending_keys.append(keys)
+        self._pending_scores.append(scores[ordered])
+        self._n_pending += len(keys)
+        if self._n_pending >= self.chunk_size:
+            self._flush()
+
+    def totals(self, n=None):
+        """
+        Return the pairs with a positive score, as arrays of first and second ids, and their
+        total scores. If ``n`` is given, return only the ``n`` highest scoring pairs, breaking
+        ties by order (as :func:`heapq.nlargest` would). Pairs are ordered by their ids.
+        """
+        self._flush()
+        keys, scores = self._keys, self._scores
+
+        keep = scores > 0
+        if n is not None and n < np.count_nonzero(keep):
+            keep = np.zeros(len(scores), dtype=bool)
+            if n > 0:
+                # The n-th highest score, all higher scores are kept and as many ties as fit
+                threshold = np.partition(scores, len(scores) - n)[len(scores) - n]
+                np.greater(scores, threshold, out=keep)
+                ties = np.flatnonzero(scores == threshold)
+                keep[ties[:n - np.count_nonzero(keep)]] = True
+
+        ids1, ids2 = np.divmod(keys[keep], self.stride)
+        return ids1, ids2, scores[keep]
+
+    def _flush(self):
+        if not self._pending_keys:
+            return
+
+        keys = np.concatenate([self._keys] + self._pending_keys)
+        scores = np.concatenate([self._scores] + self._pending_scores)
+
+        # bincount adds the scores of each key in order, so totals do not depend on the chunk size
+        self._keys, inverse = np.unique(keys, return_inverse=True)
+        self._scores = np.bincount(inverse.ravel(), weights=scores, minlength=len(self._keys))
+
+        self._pending_keys = []
+        self._pending_scores = []
+        self._n_pending = 0
+
+
+def _intersect(sorted1, sorted2):
+    """Return the positions of the values two sorted arrays of unique values have in common, in either array."""
+    positions = np.searchsorted(sorted2, sorted1)
+    found = sorted2[np.minimum(positions, len(sorted2) - 1)] == sorted1 if len(sorted2) else np.zeros(len(sorted1), dtype=bool)
+    return np.flatnonzero(found), positions[found]
+
+
+def _products(starts1, counts1, starts2, counts2):
+    """
+    Return the positions of all pairs in the products of runs ``[starts1[i], starts1[i] + counts1[i])``
+    and ``[starts2[i], starts2[i] + counts2[i])``, as two arrays, run after run.
+    """
+    n_pairs = counts1 * counts2
+    # Repeat the runs of each product once per pair
+    counts2 = np.repeat(counts2, n_pairs)
+    offsets = np.arange(n_pairs.sum()) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+    positions1 = np.repeat(starts1, n_pairs) + offsets // counts2
+    positions2 = np.repeat(starts2, n_pairs) + offsets % counts2
+    return positions1, positions2
 
 
 class CompareIndex(Index):
+    def __init__(self, k, rolling=True):
+        super().__init__(k, rolling)
+        self._index = collections.defaultdict(set)
+
+    def keys(self):
+        return self._index.keys()
+
+    def values(self):
+        return self._index.values()
+
+    def include(self, file, tokens=None):
+        """Fingerprint a file and add it to the index."""
+        for hash, val in self.fingerprint(file, tokens):
+            self._index[hash].add(val)
+
+    def include_all(self, other):
+        """Add all fingerprints from another index into this one."""
+        for hash, vals in other._index.items():
+            self._index[hash] |= vals
+        return self
+
+    def ignore_all(self, other):
+        """Remove all fingerprints in another index from this one."""
+        for hash in other._index:
+            self._index.pop(hash, None)
+
     def compare(self, other):
         matches = []
 
@@ -304,6 +918,9 @@ class CompareIndex(Index):
 
         return matches
 
+    def __bool__(self):
+        return bool(self._index)
+
     def unignored_tokens(self, file, tokens=None):
         if tokens is None:
             tokens = file.tokens()
@@ -313,7 +930,7 @@ class CompareIndex(Index):
             return [tokens]
 
         # Create an index of file with same settings as self
-        file_index = CompareIndex(k=self.k)
+        file_index = CompareIndex(k=self.k, rolling=self.rolling)
         file_index.include(file, tokens=tokens)
 
         # Figure out spans (regions) of the file to ignore
@@ -328,26 +945,30 @@ class CompareIndex(Index):
             return [tokens]
 
         # Find relevant tokens (any token not completely in an ignored_span)
+        # and split them into runs of consecutive relevant tokens
+        tokens = TokenStream.from_tokens(tokens)
         relevant_token_lists = []
-        relevant_tokens = []
+        # Index of the first token of the current run of relevant tokens
+        run_start = None
         span_iter = iter(sorted(ignored_spans, key=lambda span: span.start))
         span = next(span_iter)
-        for i, token in enumerate(tokens):
+        for i, (token_start, token_end) in enumerate(zip(tokens.starts, tokens.ends)):
             # If token comes after span, move on to next span
-            while token.end > span.end:
+            while token_end > span.end:
                 try:
                     span = next(span_iter)
                 except StopIteration:
-                    relevant_token_lists.append(relevant_tokens + tokens[i:])
+                    relevant_token_lists.append(tokens[i if run_start is None else run_start:])
                     return relevant_token_lists
 
             # If token starts before the span does, it's relevant
-            if token.start < span.start:
-                relevant_tokens.append(token)
+            if token_start < span.start:
+                if run_start is None:
+                    run_start = i
             # If a token is ignored, yield any relevant_tokens so far
-            elif relevant_tokens:
-                relevant_token_lists.append(relevant_tokens)
-                relevant_tokens = []
+            elif run_start is not None:
+                relevant_token_lists.append(tokens[run_start:i])
+                run_start = None
 
         return relevant_token_lists
 
@@ -357,10 +978,11 @@ class CompareIndex(Index):
             if not tokens:
                 return []
 
-        hashes = self.hashes(tokens)
+        tokens = TokenStream.from_tokens(tokens)
+        hashes = self.hashes(tokens).tolist()
 
-        starts = (tok.start for tok in tokens[:-self.k+1])
-        ends = itertools.chain((tok.start for tok in tokens[self.k:]), (tokens[-1].end,))
+        starts = tokens.starts[:-self.k+1]
+        ends = itertools.chain(tokens.starts[self.k:], (tokens.ends[-1],))
 
         fingerprints = []
 
@@ -369,3 +991,277 @@ class CompareIndex(Index):
             fingerprints.append((hash_, Span(file, start, end)))
 
         return fingerprints
+
+
+class ArchiveIndex(collections.abc.Sequence):
+    """
+    :param submissions: the indexed submissions
+    :type submissions: [:class:`compare50.Submission`]
+    :param pass_name: name of the pass whose comparator fingerprinted the submissions
+    :type pass_name: str
+    :param k: noise threshold of that comparator
+    :type k: int
+    :param t: guarantee threshold of that comparator
+    :type t: int
+    :param rolling: whether that comparator hashes k-grams with a rolling hash
+    :type rolling: bool
+
+    Winnowed fingerprints of (archive) submissions, computed once and stored in a file that
+    is memory-mapped on later runs, see :meth:`save` and :meth:`load`. Behaves as a sequence of
+    the indexed submissions so that it can be passed to :func:`compare50.rank` in place of
+    archive submissions, in which case :class:`Winnowing` uses the stored fingerprints rather
+    than fingerprinting them again.
+
+    Submissions are added in segments (see :meth:`append`), each of which is appended to the
+    file as is, along with a footer that only describes what was added, so that adding a
+    submission takes time (and space) proportional to its size rather than to that of the index. The index may also hold a :attr:`ranking` of its submissions, so that
+    late submissions can be ranked incrementally (see :func:`compare50.rank`).
+    """
+    MAGIC = b"C50INDEX"
+    #: Bump whenever the format of the file changes
+    VERSION = 3
+    # Offset of every array in the file is a multiple of this
+    ALIGNMENT = 64
+
+    def __init__(self, submissions, pass_name, k, t, rolling):
+        self.submissions = list(submissions)
+        self.pass_name = pass_name
+        self.k = k
+        self.t = t
+        self.rolling = rolling
+        #: Top scores of pairs of indexed submissions, if any
+        self.ranking = None
+        # Arrays of fingerprints added by each call to append (ids are positions in self.submissions)
+        self._segments = []
+        # File the index was loaded from or saved to, and the number of segments and submissions in it
+        self._path = None
+        self._n_saved = 0
+        self._n_saved_submissions = 0
+
+    def __getitem__(self, i):
+        return self.submissions[i]
+
+    def __len__(self):
+        return len(self.submissions)
+
+    def matches(self, comparator):
+        """Whether the stored fingerprints are those that ``comparator`` would compute."""
+        return (self.k, self.t, self.rolling) == (comparator.k, comparator.t, comparator.rolling)
+
+    def indices(self):
+        """Return a (new) :class:`ScoreIndex` of the fingerprints of each segment."""
+        # Ids in the arrays are positions in self.submissions
+        id_map = np.array([sub.id for sub in self.submissions], dtype=np.int64)
+
+        indices = []
+        for segment in self._segments:
+            index = ScoreIndex(self.k, self.t, self.rolling)
+            index._hashes, index._ids, index._id_map = segment["hashes"], segment["ids"], id_map
+            index._max_id = int(id_map.max())
+            index._runs = segment["unique_hashes"], segment["starts"], segment["counts"]
+            indices.append(index)
+        return indices
+
+    def frequencies(self):
+        """Return, per segment, the unique hashes and the number of files each occurs in."""
+        return [(segment["unique_hashes"], segment["frequencies"]) for segment in self._segments]
+
+    @classmethod
+    def build(cls, submissions, pass_):
+        """Index ``submissions`` with the comparator of ``pass_``, which must be :class:`Winnowing`."""
+        comparator = pass_.comparator
+        if not isinstance(comparator, Winnowing):
+            raise _api.Error(f"Pass {pass_.__name__} does not fingerprint submissions, so it cannot be used to build an index.")
+
+        index = cls([], pass_.__name__, comparator.k, comparator.t, comparator.rolling)
+        index.append(submissions)
+        return index
+
+    def check_new(self, submissions):
+        """Raise a :class:`compare50.Error` if any of ``submissions`` is in the index already."""
+        indexed = {sub.path.absolute() for sub in self.submissions}
+        for sub in submissions:
+            if sub.path.absolute() in indexed:
+                raise _api.Error(f"{sub.path} is already in the index.")
+
+    def append(self, submissions):
+        """Fingerprint ``submissions`` and add them to the index, as a new segment."""
+        submissions = sorted(submissions, key=lambda sub: str(sub.path))
+        if not submissions:
+            return
+
+        self.check_new(submissions)
+
+        files = [f for sub in submissions for f in sub]
+        bar = _api.get_progress_bar()
+        bar.reset(total=len(files))
+        with _api._new_executor() as executor:
+            index, file_hashes = Winnowing(self.k, self.t, self.rolling)._index_files(executor, files)
+
+        # Number submissions by their position in the index
+        positions = np.zeros(index._max_id + 1, dtype=np.int64)
+        positions[[sub.id for sub in submissions]] = np.arange(len(self.submissions), len(self.submissions) + len(submissions))
+        index._merge([index._hashes], [positions[index._ids]])
+
+        unique_hashes, starts, counts = index._postings()
+        _, frequencies = _count(file_hashes)
+        self._segments.append({
+            "hashes": index._hashes,
+            "ids": index._ids.astype(np.int32),
+            "unique_hashes": unique_hashes,
+            "starts": starts,
+            "counts": counts,
+            "frequencies": frequencies
+        })
+        self.submissions.extend(submissions)
+
+    def save(self, path=None):
+        """
+        Write the index to ``path``, by default to the file it was loaded from or last saved to,
+        in which case only the segments added since are written. The file consists of a header
+        that points to the last footer, and of the arrays of the segments themselves (little-endian,
+        aligned), each written (in one go) with a footer. A footer describes the segments and
+        submissions written with it, as well as the ranking, and points to the footer before it.
+        """
+        if path is None and self._path is None:
+            raise _api.Error("No path to save the index to.")
+
+        if path is None or pathlib.Path(path).absolute() == self._path:
+            path = self._path
+            # Append new segments and a new footer. Only then point the header to the new footer,
+            # so that the file is not corrupted should this be interrupted.
+            with open(path, "r+b") as f:
+                previous = self._read_header(f)
+                f.seek(0, os.SEEK_END)
+                self._write(f, self._segments[self._n_saved:], self.submissions[self._n_saved_submissions:], previous)
+        else:
+            path = pathlib.Path(path).absolute()
+            # Write to a temporary file first so that an existing index is never left half-written
+            tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+            try:
+                with open(tmp, "wb") as f:
+                    f.write(self.MAGIC)
+                    f.write(bytes(16))
+                    self._write(f, self._segments, self.submissions, None)
+                os.replace(tmp, path)
+            except BaseException:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+                raise
+
+        # Reload, so that the arrays of all segments are memory-mapped from the file
+        self._segments = self._load_segments(path, [specs for footer in self._read_footers(path)
+                                                    for specs in footer["segments"]])
+        self._path = path
+        self._n_saved = len(self._segments)
+        self._n_saved_submissions = len(self.submissions)
+
+    @classmethod
+    def load(cls, path, preprocessor=lambda tokens: tokens):
+        """Memory-map the index at ``path``, its submissions are preprocessed by ``preprocessor``."""
+        path = pathlib.Path(path).absolute()
+        footers = cls._read_footers(path)
+        footer = footers[-1]
+
+        submissions = [Submission(sub["path"], sub["files"], preprocessor=preprocessor, is_archive=sub["is_archive"])
+                       for footer_ in footers for sub in footer_["submissions"]]
+
+        index = cls(submissions, footer["pass"], footer["k"], footer["t"], footer["rolling"])
+        if footer["ranking"] is not None:
+            index.ranking = [Score(submissions[a], submissions[b], score) for a, b, score in footer["ranking"]]
+        index._segments = cls._load_segments(path, [specs for footer_ in footers for specs in footer_["segments"]])
+        index._path = path
+        index._n_saved = len(index._segments)
+        index._n_saved_submissions = len(submissions)
+        return index
+
+    def _write(self, f, segments, submissions, previous):
+        """
+        Write ``segments`` and a footer (describing them and ``submissions``) at the end of file ``f``,
+        then point its header to the footer. ``previous`` is the offset and length of the footer
+        before, if any.
+        """
+        footer_segments = []
+        for segment in segments:
+            specs = {}
+            for name, array in segment.items():
+                array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<"))
+                f.write(bytes(self._align(f.tell()) - f.tell()))
+                specs[name] = {"dtype": array.dtype.str, "length": len(array), "offset": f.tell()}
+                f.write(array.tobytes())
+            footer_segments.append(specs)
+
+        positions = {sub.id: i for i, sub in enumerate(self.submissions)}
+        ranking = None
+        if self.ranking is not None:
+            ranking = [[positions[score.sub_a.id], positions[score.sub_b.id], score.score] for score in self.ranking]
+
+        footer = json.dumps({
+            "version": self.VERSION,
+            "pass": self.pass_name,
+            "k": self.k,
+            "t": self.t,
+            "rolling": self.rolling,
+            "submissions": [{"path": str(sub.path.absolute()),
+                             "files": [str(f.name) for f in sub.files],
+                             "is_archive": sub.is_archive}
+                            for sub in submissions],
+            "ranking": ranking,
+            "segments": footer_segments,
+            "previous": previous
+        }).encode()
+
+        footer_offset = f.tell()
+        f.write(footer)
+        f.flush()
+        os.fsync(f.fileno())
+
+        f.seek(len(self.MAGIC))
+        f.write(footer_offset.to_bytes(8, "little"))
+        f.write(len(footer).to_bytes(8, "little"))
+        f.flush()
+        os.fsync(f.fileno())
+
+    @classmethod
+    def _read_header(cls, f):
+        """Return the offset and length of the last footer of file ``f``."""
+        f.seek(0)
+        if f.read(len(cls.MAGIC)) != cls.MAGIC:
+            raise _api.Error(f"{f.name} is not a compare50 index.")
+        return int.from_bytes(f.read(8), "little"), int.from_bytes(f.read(8), "little")
+
+    @classmethod
+    def _read_footers(cls, path):
+        """Return the footers of the index at ``path``, first to last."""
+        footers = []
+        with open(path, "rb") as f:
+            previous = cls._read_header(f)
+            while previous is not None:
+                offset, length = previous
+                f.seek(offset)
+                footer = json.loads(f.read(length).decode())
+                if footer.get("version") != cls.VERSION:
+                    raise _api.Error(f"{path} was built by a different version of compare50, please rebuild it.")
+                footers.append(footer)
+                previous = footer["previous"]
+        return footers[::-1]
+
+    @staticmethod
+    def _load_segments(path, specs):
+        segments = []
+        for segment_specs in specs:
+            segment = {}
+            for name, spec in segment_specs.items():
+                if spec["length"]:
+                    segment[name] = np.memmap(path, dtype=spec["dtype"], mode="r",
+                                              offset=spec["offset"], shape=(spec["length"],))
+                else:
+                    segment[name] = np.empty(0, dtype=spec["dtype"])
+            segments.append(segment)
+        return segments
+
+    @classmethod
+    def _align(cls, offset):
+        return -(-offset // cls.ALIGNMENT) * cls.ALIGNMENT
@@ -1,6 +1,8 @@
 import unittest
 import tempfile
+import itertools
 import os
+import random
 
 import compare50._data as data
 import compare50._api as api
@@ -10,7 +12,40 @@ class TestCreateSpans(unittest.TestCase):
 
 
 class TestRankSubmissions(unittest.TestCase):
-    pass
+    def setUp(self):
+        self.submissions = [data.Submission(".", [], preprocessor=lambda tokens: tokens) for _ in range(4)]
+
+    def test_legacy_comparator(self):
+        # Comparators written before n and lsh only take the submissions and ignored files
+        class Comparator(data.Comparator):
+            def score(self, submissions, archive_submissions, ignored_files):
+                return [data.Score(sub_a, sub_b, i) for i, (sub_a, sub_b)
+                        in enumerate(itertools.combinations(submissions, 2))]
+
+            def compare(self, scores, ignored_files):
+                return []
+
+        class Pass:
+            comparator = Comparator()
+
+        scores = api.rank(self.submissions, [], set(), Pass, n=2, lsh=data.LSH(2, 2))
+        self.assertEqual([score.score for score in scores], [5, 4])
+
+    def test_options(self):
+        options = []
+        class Comparator(data.Comparator):
+            def score(self, submissions, archive_submissions, ignored_files, n=None, **kwargs):
+                options.append(dict(kwargs, n=n))
+                return []
+
+            def compare(self, scores, ignored_files):
+                return []
+
+        class Pass:
+            comparator = Comparator()
+
+        api.rank(self.submissions, [], set(), Pass, n=2, reserve=1)
+        self.assertEqual(options, [{"n": 3, "lsh": None}])
 
 
 class TestGroupSpans(unittest.TestCase):
@@ -59,6 +94,33 @@ class TestGroupSpans(unittest.TestCase):
         groups = api._group_span_matches(span_matches)
         self.assertEqual(set(groups), {data.Group(spans_1), data.Group(spans_2)})
 
+    def test_subsumed_groups(self):
+        file = data.Submission(".", ["bar/foo"]).files[0]
+        span = lambda start, end: data.Span(file, start, end)
+        span_matches = [(span(0, 10), span(20, 30)),
+                        # Subsumed by the above
+                        (span(2, 5), span(22, 25)),
+                        # Only one of its spans is subsumed
+                        (span(3, 6), span(40, 43)),
+                        (span(100, 120), span(200, 220)),
+                        # Subsumed, but by a smaller group
+                        (span(101, 103), span(110, 112)), (span(110, 112), span(201, 203))]
+
+        groups = api._group_span_matches(span_matches)
+        self.assertEqual(set(groups), {data.Group([span(0, 10), span(20, 30)]),
+                                       data.Group([span(3, 6), span(40, 43)]),
+                                       data.Group([span(100, 120), span(200, 220)]),
+                                       data.Group([span(101, 103), span(110, 112), span(201, 203)])})
+
+    def test_long_chain_single_group(self):
+        # Chains far longer than the recursion limit, in any order
+        spans = [self.span(i) for i in range(20000)]
+        span_matches = [(spans[i], spans[i + 1]) for i in range(len(spans) - 1)]
+        random.Random(21).shuffle(span_matches)
+
+        groups = api._group_span_matches(span_matches)
+        self.assertEqual(list(groups), [data.Group(spans)])
+
 
 class TestFlatten(unittest.TestCase):
     def span(self, start, end):
@@ -162,5 +224,90 @@ class TestMissingSpans(unittest.TestCase):
         self.assertEqual(spans, [resulting_span])
 
 
+def token_stream(vals):
+    # A token per value, the ith of which spans [2i, 2i + 1)
+    tokens = data.TokenStream()
+    for i, val in enumerate(vals):
+        tokens.append(2 * i, 2 * i + 1, "type", val)
+    return tokens
+
+
+class TestExpand(unittest.TestCase):
+    def expand(self, vals_a, vals_b, matches):
+        # Matches are given as (start_a, start_b, length) in tokens, like the k-grams of a CompareIndex
+        span = lambda start, length: data.Span(None, 2 * start, 2 * (start + length) - 1)
+        span_matches = [(span(start_a, length), span(start_b, length)) for start_a, start_b, length in matches]
+        return sorted((span_a.start // 2, span_a.end // 2 + 1, span_b.start // 2, span_b.end // 2 + 1)
+                      for span_a, span_b in api.expand(span_matches, token_stream(vals_a), token_stream(vals_b)))
+
+    def test_no_matches(self):
+        self.assertEqual(api.expand([], token_stream("abc"), token_stream("abc")), [])
+
+    def test_expand(self):
+        self.assertEqual(self.expand("xabcdy", "zabcdz", [(2, 2, 2)]), [(1, 5, 1, 5)])
+        self.assertEqual(self.expand("abcd", "abcd", [(1, 1, 2)]), [(0, 4, 0, 4)])
+
+    def test_subsumed(self):
+        # Every match along the same diagonal expands to the same span pair
+        self.assertEqual(self.expand("abcdef", "abcdef", [(i, i, 2) for i in range(5)]), [(0, 6, 0, 6)])
+        # Matches within the spans of earlier ones on both sides are skipped
+        self.assertEqual(self.expand("abab", "abab", [(0, 0, 2), (0, 2, 2), (2, 0, 2), (2, 2, 2)]), [(0, 4, 0, 4)])
+        self.assertEqual(self.expand("abab", "abab", [(0, 2, 2), (2, 0, 2)]), [(0, 2, 2, 4), (2, 4, 0, 2)])
+
+
+class TestMaximalMatches(unittest.TestCase):
+    def matches(self, vals_a, vals_b, k):
+        return [(span_a.start // 2, span_a.end // 2 + 1, span_b.start // 2, span_b.end // 2 + 1)
+                for span_a, span_b in api.maximal_matches(None, token_stream(vals_a), None, token_stream(vals_b), k)]
+
+    def test_no_matches(self):
+        self.assertEqual(self.matches("abc", "abd", 3), [])
+        self.assertEqual(self.matches("ab", "ab", 3), [])
+        self.assertEqual(self.matches("", "abc", 1), [])
+
+    def test_maximal(self):
+        # Matches extend as far as possible, up to either end
+        self.assertEqual(self.matches("xabcdy", "abcdz", 2), [(1, 5, 0, 4)])
+        self.assertEqual(self.matches("abcd", "abcd", 4), [(0, 4, 0, 4)])
+
+    def test_repeats(self):
+        # Every pair of occurrences is a match, including overlapping ones
+        self.assertEqual(self.matches("abab", "ab", 2), [(0, 2, 0, 2), (2, 4, 0, 2)])
+        self.assertEqual(self.matches("aaa", "aa", 2), [(0, 2, 0, 2), (1, 3, 0, 2)])
+
+    def brute_force(self, vals_a, vals_b, k):
+        expected = []
+        for i in range(len(vals_a)):
+            for j in range(len(vals_b)):
+                # Matches can't be extended to the left
+                if i and j and vals_a[i - 1] == vals_b[j - 1]:
+                    continue
+                length = 0
+                while i + length < len(vals_a) and j + length < len(vals_b) \
+                        and vals_a[i + length] == vals_b[j + length]:
+                    length += 1
+                if length >= k:
+                    expected.append((i, i + length, j, j + length))
+        return expected
+
+    def test_brute_force(self):
+        rand = random.Random(19)
+        for _ in range(200):
+            vals_a = [rand.choice("abc") for _ in range(rand.randrange(20))]
+            vals_b = [rand.choice("abc") for _ in range(rand.randrange(20))]
+            k = rand.randint(1, 4)
+            self.assertEqual(self.matches(vals_a, vals_b, k), self.brute_force(vals_a, vals_b, k))
+
+    def test_periodic(self):
+        # Many suffixes share their first k tokens, but few pairs of them are maximal
+        rand = random.Random(19)
+        for _ in range(50):
+            period = [rand.choice("abc") for _ in range(rand.randint(1, 3))]
+            vals_a = period * rand.randrange(30) + [rand.choice("abcd") for _ in range(rand.randrange(4))]
+            vals_b = [rand.choice("abcd") for _ in range(rand.randrange(4))] + period * rand.randrange(30)
+            k = rand.randint(1, 4)
+            self.assertEqual(self.matches(vals_a, vals_b, k), self.brute_force(vals_a, vals_b, k))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,135 @@
+import unittest
+import tempfile
+import os
+import time
+import multiprocessing
+
+import pygments
+
+import compare50
+import compare50._api as api
+import compare50._cache as cache
+import compare50._data as data
+import compare50.passes as passes
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.working_directory = tempfile.TemporaryDirectory()
+        self._wd = os.getcwd()
+        os.chdir(self.working_directory.name)
+
+    def tearDown(self):
+        self.working_directory.cleanup()
+        os.chdir(self._wd)
+
+
+class TestTokenCache(TestCase):
+    def setUp(self):
+        super().setUp()
+        with open("foo.py", "w") as f:
+            f.write("def bar():\n"
+                    "    # baz\n"
+                    "    print('qux')\n")
+
+        self.cache = cache.TokenCache("cache")
+        data.File.token_cache = self.cache
+        data.File._raw_tokens.clear()
+
+    def tearDown(self):
+        data.File.token_cache = None
+        super().tearDown()
+
+    def test_hit(self):
+        preprocessor = data.Preprocessor(passes.structure.preprocessors)
+        file = data.Submission(".", ["foo.py"], preprocessor=preprocessor).files[0]
+
+        tokens = file.tokens()
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+
+        cached_tokens = file.tokens()
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+        self.assertEqual([(t.start, t.end, t.type, t.val) for t in cached_tokens],
+                         [(t.start, t.end, t.type, t.val) for t in tokens])
+
+    def test_spawned_workers(self):
+        # Workers that are not forked (as on macOS and Windows), and so do not inherit the cache,
+        # get it from their initializer
+        start_method = multiprocessing.get_start_method()
+        multiprocessing.set_start_method("spawn", force=True)
+        try:
+            self.cache = data.File.token_cache = cache.TokenCache("cache")
+            preprocessor = data.Preprocessor(passes.structure.preprocessors)
+            file = data.Submission(".", ["foo.py"], preprocessor=preprocessor).files[0]
+            for hits in (0, 1):
+                with api._new_executor() as executor:
+                    executor.submit(data.File.tokens, file).result()
+                self.assertEqual((self.cache.hits, self.cache.misses), (hits, 2))
+        finally:
+            multiprocessing.set_start_method(start_method, force=True)
+
+    def test_unnamed_preprocessor(self):
+        file = data.Submission(".", ["foo.py"], preprocessor=data.Preprocessor([lambda ts: ts])).files[0]
+        file.tokens()
+        data.File._raw_tokens.clear()
+        file.tokens()
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(len(os.listdir("cache")), 1)
+
+    def test_key_versions(self):
+        # Upgrading compare50 or pygments (and with it their preprocessors or lexers) invalidates entries
+        key = cache.TokenCache.key("foo", "Python", passes.structure.preprocessors)
+        for module in (compare50, pygments):
+            version = module.__version__
+            module.__version__ = "0"
+            try:
+                self.assertNotEqual(cache.TokenCache.key("foo", "Python", passes.structure.preprocessors), key)
+            finally:
+                module.__version__ = version
+        self.assertEqual(cache.TokenCache.key("foo", "Python", passes.structure.preprocessors), key)
+
+    def test_prune(self):
+        for i in range(3):
+            self.cache.put(str(i), "x" * 100)
+            os.utime(os.path.join("cache", str(i)), (time.time() - 10 + i,) * 2)
+        self.cache.get("0")
+
+        self.cache.max_size = os.path.getsize(os.path.join("cache", "0")) * 2
+        self.cache.prune()
+        self.assertEqual(sorted(os.listdir("cache")), ["0", "2"])
+
+
+class TestTokenStore(TestCase):
+    def setUp(self):
+        super().setUp()
+        with open("foo.py", "w") as f:
+            f.write("def bar():\n"
+                    "    print('qux')\n")
+        data.File._raw_tokens.clear()
+
+    def test_raw_tokens_are_reused(self):
+        def normalize(tokens):
+            for tok in tokens:
+                tok.val = "v"
+                yield tok
+
+        file = data.Submission(".", ["foo.py"], preprocessor=normalize).files[0]
+        raw_tokens = file.unprocessed_tokens()
+        self.assertTrue(all(tok.val == "v" for tok in file.tokens()))
+
+        # Preprocessing must not affect the stored raw tokens
+        self.assertEqual([tok.val for tok in file.unprocessed_tokens()], [tok.val for tok in raw_tokens])
+
+    def test_eviction(self):
+        store = cache.TokenStore(max_tokens=3)
+        store.put("a", [1, 2])
+        store.put("b", [3])
+        store.get("a")
+        store.put("c", [4])
+        self.assertIsNone(store.get("b"))
+        self.assertEqual(store.get("a"), [1, 2])
+        self.assertEqual(store.get("c"), [4])
+
+
+if __name__ == "__main__":
+    unittest.main()
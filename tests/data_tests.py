@@ -0,0 +1,49 @@
+import unittest
+import pickle
+
+from pygments.token import Name, Text
+
+import compare50._data as data
+
+
+class TestTokenStream(unittest.TestCase):
+    def setUp(self):
+        self.tokens = [data.Token(0, 3, Name, "foo"),
+                       data.Token(3, 4, Text, " "),
+                       data.Token(4, 7, Name, "bar")]
+        self.stream = data.TokenStream.from_tokens(self.tokens)
+
+    def test_from_tokens(self):
+        self.assertEqual(len(self.stream), 3)
+        self.assertEqual(list(self.stream.starts), [0, 3, 4])
+        self.assertEqual(list(self.stream.ends), [3, 4, 7])
+        self.assertEqual(self.stream.vals, ["foo", " ", "bar"])
+        self.assertEqual(self.stream.types, [Name, Text, Name])
+        self.assertIs(data.TokenStream.from_tokens(self.stream), self.stream)
+
+    def test_getitem(self):
+        token = self.stream[2]
+        self.assertEqual((token.start, token.end, token.type, token.val), (4, 7, Name, "bar"))
+
+        stream = self.stream[1:]
+        self.assertIsInstance(stream, data.TokenStream)
+        self.assertEqual(list(stream.starts), [3, 4])
+
+    def test_interned_ids(self):
+        self.assertEqual(self.stream.val_ids[0], data.TokenStream.from_tokens([data.Token(9, 12, Name, "foo")]).val_ids[0])
+        self.assertNotEqual(self.stream.val_ids[0], self.stream.val_ids[2])
+
+    def test_eq(self):
+        self.assertEqual(self.stream, self.tokens)
+        self.assertEqual(self.stream[:1] + self.stream[1:], self.stream)
+        self.assertNotEqual(self.stream[1:], self.stream[:2])
+
+    def test_pickle(self):
+        stream = pickle.loads(pickle.dumps(self.stream))
+        self.assertEqual(stream, self.stream)
+        self.assertEqual(list(stream.starts), list(self.stream.starts))
+        self.assertIs(stream.types[0], Name)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -104,5 +104,20 @@ class TestSubmissionFactory(TestCase):
         self.assertEqual(subs, set())
 
 
+class TestFrequency(unittest.TestCase):
+    def test_number_of_files(self):
+        self.assertEqual(main.frequency("1"), 1)
+        self.assertEqual(main.frequency("20"), 20)
+
+    def test_fraction(self):
+        self.assertEqual(main.frequency("0.5"), 0.5)
+        self.assertEqual(main.frequency("1.0"), 1.0)
+
+    def test_out_of_bounds(self):
+        for value in ("0", "-3", "0.0", "1.5", "-0.5"):
+            with self.assertRaises(main.argparse.ArgumentTypeError):
+                main.frequency(value)
+
+
 if __name__ == "__main__":
     unittest.main()
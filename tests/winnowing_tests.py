@@ -1,10 +1,22 @@
 import unittest
 import tempfile
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import math
+import multiprocessing
 import os
+import random
+import subprocess
 import sys
 
+import numpy as np
+
 import compare50.comparators._winnowing as winnowing
 import compare50._data as data
+import compare50._api as api
+import compare50.passes as passes
 
 class TestCase(unittest.TestCase):
     def setUp(self):
@@ -58,6 +70,571 @@ class TestCompareIndexIgnoreTokens(TestCase):
         self.assertEqual(relevant_token_lists[0], expected_tokens)
 
 
+class TestRollingHashes(TestCase):
+    def test_rolling_hashes(self):
+        index = winnowing.CompareIndex(k=3, rolling=True)
+        ids = [5, 2**64 - 7, 2**63, 11, 0, 3, 2**64 - 1, 42, 7]
+
+        expected = []
+        for i in range(len(ids) - 2):
+            hash_ = 0
+            for id in ids[i:i + 3]:
+                hash_ = (hash_ * winnowing._BASE + id) % 2**64
+            expected.append(hash_)
+
+        ids = np.array(ids, dtype=np.uint64)
+        self.assertEqual(index.rolling_hashes(ids).tolist(), expected)
+        self.assertEqual(index.polynomial_hashes(ids).tolist(), expected)
+        self.assertEqual(index.rolling_hashes(ids[:2]).tolist(), [])
+        self.assertEqual(index.polynomial_hashes(ids[:2]).tolist(), [])
+
+    def test_rolling_matches(self):
+        with open("foo.py", "w") as f:
+            f.write("def bar():\n    print('qux')\n    return 1\n")
+        with open("baz.py", "w") as f:
+            f.write("x = 2\ndef bar():\n    print('qux')\n")
+        file_a, file_b = data.Submission(".", ["foo.py", "baz.py"]).files
+
+        matches = {}
+        for rolling in (False, True):
+            index_a = winnowing.CompareIndex(k=3, rolling=rolling)
+            index_a.include(file_a)
+            index_b = winnowing.CompareIndex(k=3, rolling=rolling)
+            index_b.include(file_b)
+            matches[rolling] = set(index_a.compare(index_b))
+
+        self.assertTrue(matches[True])
+        self.assertEqual(matches[True], matches[False])
+
+
+class TestStableHashes(TestCase):
+    def setUp(self):
+        super().setUp()
+        with open("foo.py", "w") as f:
+            f.write("def bar():\n    print('qux')\n    return 1\n")
+        self.file = data.Submission(".", ["foo.py"]).files[0]
+
+    def test_rolling_equals_non_rolling(self):
+        tokens = self.file.tokens()
+        self.assertEqual(winnowing.CompareIndex(k=3, rolling=True).hashes(tokens).tolist(),
+                         winnowing.CompareIndex(k=3, rolling=False).hashes(tokens).tolist())
+
+    def test_process_independent(self):
+        hashes = winnowing.CompareIndex(k=3).hashes(self.file.tokens()).tolist()
+        self.assertTrue(all(0 <= hash_ < 2**64 for hash_ in hashes))
+
+        code = "import compare50._data as data, compare50.comparators._winnowing as winnowing;" \
+               "print(winnowing.CompareIndex(k=3).hashes(data.Submission('.', ['foo.py']).files[0].tokens()).tolist())"
+        # Make sure the subprocess imports this very compare50
+        root = os.path.dirname(os.path.dirname(data.__file__))
+        for seed in ("1", "2"):
+            env = dict(os.environ, PYTHONHASHSEED=seed, PYTHONPATH=root)
+            output = subprocess.check_output([sys.executable, "-c", code], env=env)
+            self.assertEqual(output.decode().strip(), str(hashes))
+
+
+class TestScoreIndexFingerprint(TestCase):
+    @staticmethod
+    def reference_fingerprint(hashes, w, id):
+        """Winnowing with a circular buffer that is rescanned whenever the minimum leaves it."""
+        fingerprints = []
+        buf = [(math.inf, None)] * w
+        min_idx = 0
+        for hash_, idx in zip(hashes, itertools.cycle(range(w))):
+            buf[idx] = hash_, id
+            if min_idx == idx:
+                for j in range(1, w):
+                    search_idx = (idx - j) % w
+                    if buf[search_idx][0] < buf[min_idx][0]:
+                        min_idx = search_idx
+                fingerprints.append(buf[min_idx])
+            elif buf[idx][0] < buf[min_idx][0]:
+                min_idx = idx
+                fingerprints.append(buf[min_idx])
+        return fingerprints
+
+    def assertSameFingerprints(self, index, file, tokens=None):
+        tokens = file.tokens() if tokens is None else tokens
+        expected = self.reference_fingerprint(index.hashes(tokens), index.w, file.submission.id)
+        self.assertEqual(index.fingerprint(file, tokens), expected)
+
+    def test_corpus(self):
+        # The test files, as well as compare50's own (considerably larger) source files
+        corpus = [os.path.join(os.path.dirname(__file__), "files", sub) for sub in ("sub_a", "sub_b", "sub_c")]
+        corpus.append(os.path.dirname(data.__file__))
+        for path in corpus:
+            submission = data.Submission(path, sorted(f for f in os.listdir(path) if f.endswith(".py")))
+            for file in submission.files:
+                for k, t in ((2, 3), (2, 5), (25, 35)):
+                    self.assertSameFingerprints(winnowing.ScoreIndex(k=k, t=t), file)
+
+    def test_ties(self):
+        with open("foo.py", "w") as f:
+            f.write("")
+        file = data.Submission(".", ["foo.py"]).files[0]
+
+        rand = random.Random(50)
+        for w in (1, 2, 4, 11):
+            index = winnowing.ScoreIndex(k=1, t=w)
+            for _ in range(50):
+                hashes = [rand.randrange(4) for _ in range(rand.randrange(1, 40))]
+                index.hashes = lambda tokens: np.array(hashes, dtype=np.uint64)
+                self.assertSameFingerprints(index, file, tokens=hashes)
+
+
+class TestPairScores(TestCase):
+    def test_same_as_dense(self):
+        rand = random.Random(50)
+        additions = [({rand.randrange(10) for _ in range(rand.randrange(1, 4))},
+                      {rand.randrange(12) for _ in range(rand.randrange(1, 4))},
+                      rand.random())
+                     for _ in range(200)]
+
+        dense = np.zeros((10, 12))
+        for ids1, ids2, score in additions:
+            for id1, id2 in itertools.product(ids1, ids2):
+                dense[id1, id2] += score
+        expected = [(id1, id2, dense[id1, id2]) for id1, id2 in zip(*np.nonzero(np.triu(dense, 1)))]
+
+        for chunk_size in (1, 7, 2**20):
+            scores = winnowing._PairScores(12, chunk_size=chunk_size)
+            for ids1, ids2, score in additions:
+                pairs = np.array(list(itertools.product(ids1, ids2)))
+                scores.add(pairs[:, 0], pairs[:, 1], np.full(len(pairs), score))
+            ids1, ids2, totals = scores.totals()
+            self.assertEqual(list(zip(ids1.tolist(), ids2.tolist(), totals.tolist())), expected)
+
+    def test_top_n(self):
+        scores = winnowing._PairScores(10)
+        for id1, score in ((0, 1), (1, 3), (2, 2), (3, 3), (4, 2), (5, 2), (6, 0)):
+            scores.add(np.array([id1]), np.array([9]), np.array([score]))
+
+        expected = [(id1, 9, score) for id1, score in ((0, 1), (1, 3), (2, 2), (3, 3), (4, 2), (5, 2))]
+        for n in range(8):
+            ids1, ids2, totals = scores.totals(n)
+            top = list(zip(ids1.tolist(), ids2.tolist(), totals.tolist()))
+            self.assertEqual(sorted(top, key=lambda pair: -pair[2]),
+                             heapq.nlargest(n, expected, key=lambda pair: pair[2]))
+
+
+class TestScoreIndex(TestCase):
+    def setUp(self):
+        super().setUp()
+        api.progress_bar(disable=True)
+        self.submissions = []
+        rand = random.Random(50)
+        for i in range(8):
+            with open(f"{i}.py", "w") as f:
+                # Mix of shared and unique statements
+                f.write("\n".join(f"x{rand.randrange(12)} = {rand.randrange(3)}" for _ in range(40)))
+            self.submissions.append(data.Submission(".", [f"{i}.py"]))
+
+    def test_same_as_sets(self):
+        indices = []
+        expected = collections.defaultdict(set)
+        for sub in self.submissions:
+            index = winnowing.ScoreIndex(k=3, t=5)
+            index.include(sub.files[0])
+            indices.append(index)
+            for hash_, id in index.fingerprint(sub.files[0]):
+                expected[hash_].add(id)
+
+        index = winnowing.ScoreIndex(k=3, t=5).include_all(*indices)
+        self.assertEqual(index.keys().tolist(), sorted(expected))
+        self.assertEqual(index._max_id, max(sub.id for sub in self.submissions))
+
+        # Every pair of submissions, scored by the number of fingerprints they share
+        expected_scores = collections.Counter()
+        for ids in expected.values():
+            for id1, id2 in itertools.combinations(sorted(ids), 2):
+                expected_scores[id1, id2] += 1
+
+        for chunk_size in (1, 5, 2**20):
+            scores = {(score.sub_a.id, score.sub_b.id): score.score
+                      for score in index.compare(index, chunk_size=chunk_size)}
+            self.assertEqual(scores, expected_scores)
+
+    def test_index_files(self):
+        expected = winnowing.ScoreIndex(k=3, t=5)
+        for sub in self.submissions:
+            expected.include(sub.files[0])
+
+        files = [sub.files[0] for sub in self.submissions]
+        index, file_hashes = winnowing.Winnowing(k=3, t=5)._index_files(api.FauxExecutor(), files)
+
+        self.assertEqual(index._hashes.tolist(), expected._hashes.tolist())
+        self.assertEqual(index._ids.tolist(), expected._ids.tolist())
+        self.assertEqual(index._max_id, expected._max_id)
+        self.assertEqual([hashes.tolist() for hashes in file_hashes],
+                         [sorted(set(hash_ for hash_, _ in expected.fingerprint(file))) for file in files])
+
+    def test_index_files_ignore(self):
+        comparator = winnowing.Winnowing(k=3, t=5)
+        files = [sub.files[0] for sub in self.submissions]
+        ignored, _ = comparator._index_files(api.FauxExecutor(), files[:1])
+        expected, _ = comparator._index_files(api.FauxExecutor(), files)
+        expected.ignore_all(ignored)
+
+        executor = api.FauxExecutor(initializer=winnowing._set_ignored_hashes, initargs=(ignored.keys(),))
+        index, file_hashes = comparator._index_files(executor, files, ignore=True)
+
+        self.assertEqual(index._hashes.tolist(), expected._hashes.tolist())
+        self.assertEqual(index._ids.tolist(), expected._ids.tolist())
+        self.assertEqual(file_hashes[0].tolist(), [])
+
+    def test_max_frequency(self):
+        executor = api.Executor
+        api.Executor = api.FauxExecutor
+        try:
+            comparator = winnowing.Winnowing(k=3, t=5)
+            expected = comparator.score(self.submissions, [], set())
+            self.assertIsNone(comparator.pruned)
+
+            # A hash shared by 2 submissions adds a single pair, so skipping those in more drops the others
+            index, _ = comparator._index_files(api.FauxExecutor(), [sub.files[0] for sub in self.submissions])
+            postings = index._postings()[2]
+
+            for max_frequency in (2, 2 / len(self.submissions)):
+                comparator.max_frequency = max_frequency
+                scores = comparator.score(self.submissions, [], set())
+                self.assertEqual(comparator.pruned.fingerprints, np.count_nonzero(postings > 2))
+                self.assertEqual(comparator.pruned.postings, postings[postings > 2].sum())
+                self.assertEqual(comparator.pruned.pairs, (postings[postings > 2] ** 2).sum())
+                self.assertTrue(scores)
+                self.assertLess(len(scores), len(expected))
+        finally:
+            api.Executor = executor
+
+    def test_max_frequency_of_submissions(self):
+        os.mkdir("twice")
+        for name in ("twice/a.py", "twice/b.py", "once.py"):
+            with open(name, "w") as f, open("0.py") as original:
+                f.write(original.read())
+        submissions = [data.Submission("twice", ["a.py", "b.py"]), data.Submission(".", ["once.py"])] + self.submissions[1:]
+
+        executor = api.Executor
+        api.Executor = api.FauxExecutor
+        try:
+            # The fraction is one of submissions, so a second copy of a file in a submission changes nothing
+            comparator = winnowing.Winnowing(k=3, t=5, max_frequency=2.5 / len(submissions))
+            comparator.score([data.Submission("twice", ["a.py"])] + submissions[1:], [], set())
+            expected = comparator.pruned.fingerprints
+            comparator.score(submissions, [], set())
+            self.assertEqual(comparator.pruned.fingerprints, expected)
+        finally:
+            api.Executor = executor
+
+    def test_lsh(self):
+        with open("copy.py", "w") as f, open("0.py") as original:
+            f.write(original.read())
+        submissions = self.submissions + [data.Submission(".", ["copy.py"])]
+
+        executor = api.Executor
+        api.Executor = api.FauxExecutor
+        try:
+            comparator = winnowing.Winnowing(k=3, t=5)
+            expected = {(score.sub_a.id, score.sub_b.id): score.score
+                        for score in comparator.score(submissions, [], set())}
+            for lsh in (data.LSH(), data.LSH(bands=4, rows=8)):
+                scores = {(score.sub_a.id, score.sub_b.id): score.score
+                          for score in comparator.score(submissions, [], set(), lsh=lsh)}
+
+                # Candidates are scored exactly, and identical submissions are always candidates
+                self.assertIn((submissions[0].id, submissions[-1].id), scores)
+                for pair, score in scores.items():
+                    self.assertAlmostEqual(score, expected[pair])
+        finally:
+            api.Executor = executor
+
+    def test_lsh_no_candidates(self):
+        for name in ("copy_a.py", "copy_b.py"):
+            with open(name, "w") as f:
+                f.write("def other(x):\n    return [x ** i for i in range(x)]\n")
+        archive = [data.Submission(".", [name], is_archive=True) for name in ("copy_a.py", "copy_b.py")]
+
+        executor = api.Executor
+        api.Executor = api.FauxExecutor
+        try:
+            # Identical archive submissions are the only candidates, yet they are not compared to each other
+            comparator = winnowing.Winnowing(k=3, t=5)
+            self.assertEqual(comparator.score(self.submissions[:1], archive, set(), lsh=data.LSH(bands=1, rows=32)), [])
+        finally:
+            api.Executor = executor
+
+    def test_lsh_candidates(self):
+        signatures = np.array([[1, 1, 2], [3, 3, 3]], dtype=np.uint64)
+        self.assertEqual([ids.tolist() for ids in winnowing._lsh_candidates(signatures, bands=1, rows=2)],
+                         [[0], [1]])
+        self.assertEqual([ids.tolist() for ids in winnowing._lsh_candidates(signatures, bands=2, rows=1)],
+                         [[0, 0, 1], [1, 2, 2]])
+
+    def test_ignore_all(self):
+        index = winnowing.ScoreIndex(k=3, t=5)
+        for sub in self.submissions:
+            index.include(sub.files[0])
+
+        ignored_index = winnowing.ScoreIndex(k=3, t=5)
+        ignored_index.include(self.submissions[0].files[0])
+        index.ignore_all(ignored_index)
+
+        self.assertTrue(index)
+        self.assertFalse(set(index.keys().tolist()) & set(ignored_index.keys().tolist()))
+        self.assertNotIn(self.submissions[0].id, index._ids.tolist())
+
+    def test_empty(self):
+        index = winnowing.ScoreIndex(k=3, t=5)
+        self.assertFalse(index)
+        self.assertEqual(index.keys().tolist(), [])
+
+        other = winnowing.ScoreIndex(k=3, t=5)
+        other.include(self.submissions[0].files[0])
+        other.ignore_all(index)
+        self.assertTrue(other)
+        self.assertEqual(index.compare(other), [])
+
+
+class TestCompare(TestCase):
+    def setUp(self):
+        super().setUp()
+        api.progress_bar(disable=True)
+        self._executor = api.Executor
+
+        shared = "def foo(bar):\n    for i in range(bar):\n        print(i * bar + 1)\n    return bar\n"
+        for i in range(3):
+            os.makedirs(f"sub{i}")
+            with open(f"sub{i}/foo.py", "w") as f:
+                f.write(f"x = {i}\n" + shared + f"y = {i} * {i}\n")
+            with open(f"sub{i}/bar.py", "w") as f:
+                f.write(f"print('{i}')\nimport sys\n")
+        with open("distro.py", "w") as f:
+            f.write("import sys\n")
+
+        # Submissions are sent to worker processes, so their preprocessor must be picklable
+        preprocessor = data.Preprocessor(passes.structure.preprocessors)
+        self.submissions = [data.Submission(f"sub{i}", ["foo.py", "bar.py"], preprocessor=preprocessor) for i in range(3)]
+        self.ignored_files = set(data.Submission(".", ["distro.py"], preprocessor=preprocessor).files)
+        self.scores = [data.Score(sub_a, sub_b, 1) for sub_a, sub_b in itertools.combinations(self.submissions, 2)]
+
+    def tearDown(self):
+        api.Executor = self._executor
+        super().tearDown()
+
+    def compare(self, suffix_array=False):
+        comparisons = winnowing.Winnowing(k=3, t=5, suffix_array=suffix_array).compare(self.scores, self.ignored_files)
+        return [(sorted((a.file.id, a.start, a.end, b.file.id, b.start, b.end) for a, b in comparison.span_matches),
+                 sorted((span.file.id, span.start, span.end)
+                        for spans in comparison.ignored_spans.values() for span in spans))
+                for comparison in comparisons]
+
+    def test_parallel(self):
+        api.Executor = api.FauxExecutor
+        expected = self.compare()
+        api.Executor = concurrent.futures.ProcessPoolExecutor
+
+        self.assertTrue(all(span_matches and ignored_spans for span_matches, ignored_spans in expected))
+        self.assertEqual(self.compare(), expected)
+
+    def test_shared_caches(self):
+        api.Executor = api.FauxExecutor
+
+        # The caches of the files are shared with the workers for as long as the comparisons are around
+        comparisons = winnowing.Winnowing(k=3, t=5).compare(self.scores, self.ignored_files)
+        caches, = api._worker_state.values()
+        self.assertEqual(set(caches), {file.id for sub in self.submissions for file in sub})
+        del comparisons
+        self.assertEqual(api._worker_state, {})
+
+    def test_suffix_array(self):
+        api.Executor = api.FauxExecutor
+        # Expanding finds (a subset of) the same maximal matches
+        for (expanded, ignored_spans), (maximal, ignored_spans_) in zip(self.compare(), self.compare(suffix_array=True)):
+            self.assertTrue(expanded)
+            self.assertLessEqual(set(expanded), set(maximal))
+            self.assertEqual(ignored_spans, ignored_spans_)
+
+    def test_ignored_spans_by_file(self):
+        for comparison in winnowing.Winnowing(k=3, t=5).compare(self.scores, self.ignored_files):
+            files = list(itertools.chain(comparison.sub_a.files, comparison.sub_b.files))
+            self.assertEqual(set(comparison.ignored_spans), set(files))
+            for file in files:
+                self.assertTrue(all(span.file == file for span in comparison.ignored_spans[file]))
+
+    def test_ignored_spans_as_list(self):
+        api.Executor = api.FauxExecutor
+
+        # Comparators written before ignored spans were grouped by file return a plain list of them
+        class Comparator(winnowing.Winnowing):
+            def compare(self, scores, ignored_files):
+                return [data.Comparison(comparison.sub_a, comparison.sub_b, comparison.span_matches,
+                                        [span for spans in comparison.ignored_spans.values() for span in spans])
+                        for comparison in super().compare(scores, ignored_files)]
+
+        class Pass:
+            comparator = winnowing.Winnowing(k=3, t=5)
+
+        class LegacyPass:
+            comparator = Comparator(k=3, t=5)
+
+        expected = api.compare(self.scores, self.ignored_files, Pass)
+        results = api.compare(self.scores, self.ignored_files, LegacyPass)
+        self.assertEqual([(result.groups, result.ignored_spans) for result in results],
+                         [(result.groups, result.ignored_spans) for result in expected])
+
+    def test_interleaved(self):
+        api.Executor = api.FauxExecutor
+        expected = self.compare()
+
+        # Comparisons are generated lazily, so those of several comparators can be under way at once
+        first = winnowing.Winnowing(k=3, t=5).compare(self.scores, self.ignored_files)
+        second = winnowing.Winnowing(k=4, t=5).compare(self.scores, self.ignored_files)
+        for comparison, _ in zip(first, second):
+            self.assertEqual(sorted((a.file.id, a.start, a.end, b.file.id, b.start, b.end)
+                                    for a, b in comparison.span_matches), expected.pop(0)[0])
+        self.assertEqual(expected, [])
+
+    def test_compare_stream(self):
+        api.Executor = api.FauxExecutor
+        passes_ = [passes.structure, passes.exact]
+
+        expected = []
+        for pass_ in passes_:
+            preprocessor = data.Preprocessor(pass_.preprocessors)
+            for file in itertools.chain(self.ignored_files, *self.submissions):
+                object.__setattr__(file.submission, "preprocessor", preprocessor)
+            expected.append(api.compare(self.scores, self.ignored_files, pass_))
+        self.assertNotEqual([result.groups for result in expected[0]], [result.groups for result in expected[1]])
+
+        # One list of results per pair, of every pass, even though each pass has its own preprocessors
+        results = api.compare_stream(self.scores, self.ignored_files, passes_)
+        self.assertEqual(list(results), [list(results) for results in zip(*expected)])
+
+        # The same in parallel, with a single pool of workers for every pass, gone once the stream ends
+        api.Executor = concurrent.futures.ProcessPoolExecutor
+        results = api.compare_stream(self.scores, self.ignored_files, passes_)
+        self.assertEqual(next(results), list(next(zip(*expected))))
+        self.assertLessEqual(len(multiprocessing.active_children()), os.cpu_count())
+        self.assertEqual(list(results), [list(results) for results in zip(*expected)][1:])
+        self.assertIsNone(api._shared_executor)
+        self.assertEqual(multiprocessing.active_children(), [])
+
+        # A stream that is closed before it starts starts no workers at all
+        api.compare_stream(self.scores, self.ignored_files, passes_).close()
+        self.assertIsNone(api._shared_executor)
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_spans_of_own_files(self):
+        files = {id(file) for sub in self.submissions for file in sub}
+        for comparison in winnowing.Winnowing(k=3, t=5).compare(self.scores, self.ignored_files):
+            for span_a, span_b in comparison.span_matches:
+                self.assertIn(id(span_a.file), files)
+                self.assertIn(id(span_b.file), files)
+
+
+class TestArchiveIndex(TestCase):
+    def setUp(self):
+        super().setUp()
+        api.progress_bar(disable=True)
+        self._executor = api.Executor
+        api.Executor = api.FauxExecutor
+
+        rand = random.Random(50)
+        for name in ("sub", "archive"):
+            for i in range(4):
+                os.makedirs(f"{name}{i}")
+                with open(f"{name}{i}/foo.py", "w") as f:
+                    f.write("\n".join(f"x{rand.randrange(12)} = {rand.randrange(3)}" for _ in range(40)))
+
+        self.pass_ = passes.structure
+        self.preprocessor = data.Preprocessor(self.pass_.preprocessors)
+        self.submissions = [data.Submission(f"sub{i}", ["foo.py"], preprocessor=self.preprocessor) for i in range(4)]
+
+    def tearDown(self):
+        api.Executor = self._executor
+        super().tearDown()
+
+    def archive_submissions(self):
+        return [data.Submission(f"archive{i}", ["foo.py"], preprocessor=self.preprocessor, is_archive=True)
+                for i in range(4)]
+
+    def test_save_load(self):
+        index = winnowing.ArchiveIndex.build(self.archive_submissions(), self.pass_)
+        segments = [{name: array.tolist() for name, array in segment.items()} for segment in index._segments]
+        index.save("archive.idx")
+        loaded = winnowing.ArchiveIndex.load("archive.idx", self.preprocessor)
+
+        self.assertEqual(len(loaded), 4)
+        self.assertEqual([sub.path for sub in loaded], [sub.path.absolute() for sub in index])
+        self.assertTrue(all(sub.is_archive for sub in loaded))
+        self.assertTrue(loaded.matches(self.pass_.comparator))
+        self.assertIsNone(loaded.ranking)
+        self.assertEqual([{name: array.tolist() for name, array in segment.items()} for segment in loaded._segments],
+                         segments)
+
+    def test_rank(self):
+        expected = api.rank(self.submissions, self.archive_submissions(), set(), self.pass_)
+
+        winnowing.ArchiveIndex.build(self.archive_submissions(), self.pass_).save("archive.idx")
+        scores = api.rank(self.submissions, winnowing.ArchiveIndex.load("archive.idx", self.preprocessor),
+                          set(), self.pass_)
+
+        self.assertTrue(expected)
+        self.assertEqual([(score.sub_a.path.name, score.sub_b.path.name, score.score) for score in scores],
+                         [(score.sub_a.path.name, score.sub_b.path.name, score.score) for score in expected])
+
+    def test_append(self):
+        archive_subs = self.archive_submissions()
+        index = winnowing.ArchiveIndex.build(archive_subs[:2], self.pass_)
+        index.save("archive.idx")
+
+        loaded = winnowing.ArchiveIndex.load("archive.idx", self.preprocessor)
+        loaded.append(archive_subs[2:])
+        loaded.save()
+        with self.assertRaises(api.Error):
+            loaded.append(archive_subs[2:])
+        with self.assertRaises(api.Error):
+            loaded.check_new(self.submissions + archive_subs[:1])
+        loaded.check_new(self.submissions)
+
+        loaded = winnowing.ArchiveIndex.load("archive.idx", self.preprocessor)
+        self.assertEqual([sub.path.name for sub in loaded], [sub.path.name for sub in archive_subs])
+        self.assertEqual(len(loaded._segments), 2)
+
+        # Each footer only describes what was added with it
+        footers = winnowing.ArchiveIndex._read_footers(loaded._path)
+        self.assertEqual([[os.path.basename(sub["path"]) for sub in footer["submissions"]] for footer in footers],
+                         [["archive0", "archive1"], ["archive2", "archive3"]])
+        self.assertEqual([len(footer["segments"]) for footer in footers], [1, 1])
+
+        scores = api.rank(self.submissions, loaded, set(), self.pass_)
+        expected = api.rank(self.submissions, archive_subs, set(), self.pass_)
+        self.assertEqual([(score.sub_a.path.name, score.sub_b.path.name, score.score) for score in scores],
+                         [(score.sub_a.path.name, score.sub_b.path.name, score.score) for score in expected])
+
+    def test_rank_incremental(self):
+        expected = api.rank(self.submissions, [], set(), self.pass_)
+
+        # Rank the first two submissions, then rank the others against those incrementally
+        index = winnowing.ArchiveIndex.build([], self.pass_)
+        index.ranking = api.rank(self.submissions[:2], index, set(), self.pass_)
+        index.append(self.submissions[:2])
+        index.save("archive.idx")
+        index = winnowing.ArchiveIndex.load("archive.idx", self.preprocessor)
+
+        self.assertEqual(len(index.ranking), 1)
+        scores = api.rank(self.submissions[2:], index, set(), self.pass_, ranking=index.ranking)
+
+        # Pairs with a late submission score as if all were ranked at once, the others are as ranked before
+        names = lambda scores: {frozenset((score.sub_a.path.name, score.sub_b.path.name)): score.score for score in scores}
+        self.assertEqual(names(scores), {**names(expected), **names(index.ranking)})
+        self.assertEqual(len(scores), len(expected))
+
+    def test_not_an_index(self):
+        with open("archive.idx", "wb") as f:
+            f.write(b"foo")
+        with self.assertRaises(api.Error):
+            winnowing.ArchiveIndex.load("archive.idx")
+
+
 if __name__ == "__main__":
     suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
     unittest.TextTestRunner(verbosity=2).run(suite)